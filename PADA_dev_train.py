@@ -1,4 +1,5 @@
 import argparse
+import functools
 import os
 import os.path as osp
 
@@ -13,94 +14,38 @@ import torch.utils.data as util_data
 import lr_schedule
 import data_list
 from data_list import ImageList
+from evaluation import StreamingEvaluator
+from image_cache import SharedImageCache
+from image_shard import ShardImageList
 from torch.autograd import Variable
 import random
 
 import dev
 import seperate_data as sep
+from feature_store import FeatureStore
 
 
 optim_dict = {"SGD": optim.SGD}
 
 def image_classification_predict(loader, model, test_10crop=True, gpu=True, softmax_param=1.0):
-    start_test = True
-    if test_10crop:
-        iter_test = [iter(loader['test'+str(i)]) for i in range(10)]
-        for i in range(len(loader['test0'])):
-            data = [iter_test[j].next() for j in range(10)]
-            inputs = [data[j][0] for j in range(10)]
-            labels = data[0][1]
-            if gpu:
-                for j in range(10):
-                    inputs[j] = Variable(inputs[j].cuda())
-                labels = Variable(labels.cuda())
-            else:
-                for j in range(10):
-                    inputs[j] = Variable(inputs[j])
-                labels = Variable(labels)
-            outputs = []
-            for j in range(10):
-                _, predict_out = model(inputs[j])
-                outputs.append(nn.Softmax(dim=1)(softmax_param * predict_out))
-            softmax_outputs = sum(outputs)
-            if start_test:
-                all_softmax_output = softmax_outputs.data.cpu().float()
-                start_test = False
-            else:
-                all_softmax_output = torch.cat((all_softmax_output, softmax_outputs.data.cpu().float()), 0)
-    else:
-        iter_val = iter(loader["test"])
-        for i in range(len(loader['test'])):
-            data = iter_val.next()
-            inputs = data[0]
+    # mean softmax output over the test set, with test_10crop the softmax of the 10 views of an image is summed
+    evaluator = StreamingEvaluator(n_view=10 if test_10crop else 1, softmax_param=softmax_param)
+    with torch.no_grad():
+        for inputs, labels in loader["test"]:
             if gpu:
                 inputs = Variable(inputs.cuda())
             else:
                 inputs = Variable(inputs)
             _, outputs = model(inputs)
-            softmax_outputs = nn.Softmax(dim=1)(softmax_param * outputs)
-            if start_test:
-                all_softmax_output = softmax_outputs.data.cpu().float()
-                start_test = False
-            else:
-                all_softmax_output = torch.cat((all_softmax_output, softmax_outputs.data.cpu().float()), 0)
-    return all_softmax_output
+            evaluator.update(outputs)
+    return evaluator.mean_softmax().cpu()
 
 def image_classification_test(loader, model, test_10crop=True, gpu=True, iter_num=-1):
     # 与之前的区别 在于 这里在前面的基础上 又见上了对label的predict 然后通过label计算了 accuracy
-    start_test = True
-    if test_10crop:
-        iter_test = [iter(loader['test'+str(i)]) for i in range(10)]
-        for i in range(len(loader['test0'])):
-            data = [iter_test[j].next() for j in range(10)]
-            inputs = [data[j][0] for j in range(10)]
-            labels = data[0][1]
-            if gpu:
-                for j in range(10):
-                    inputs[j] = Variable(inputs[j].cuda())
-                labels = Variable(labels.cuda())
-            else:
-                for j in range(10):
-                    inputs[j] = Variable(inputs[j])
-                labels = Variable(labels)
-            outputs = []
-            for j in range(10):
-                _, predict_out = model(inputs[j])
-                outputs.append(nn.Softmax(dim=1)(predict_out))
-            outputs = sum(outputs)
-            if start_test:
-                all_output = outputs.data.float()
-                all_label = labels.data.float()
-                start_test = False
-            else:
-                all_output = torch.cat((all_output, outputs.data.float()), 0)
-                all_label = torch.cat((all_label, labels.data.float()), 0)
-    else:
-        iter_test = iter(loader["test"])
-        for i in range(len(loader['test'])):
-            data = iter_test.next()
-            inputs = data[0]
-            labels = data[1]
+    # with test_10crop the 10 views of every image go through the model in one batch and their softmax is summed
+    evaluator = StreamingEvaluator(n_view=10 if test_10crop else 1)
+    with torch.no_grad():
+        for inputs, labels in loader["test"]:
             if gpu:
                 inputs = Variable(inputs.cuda())
                 labels = Variable(labels.cuda())
@@ -108,22 +53,32 @@ def image_classification_test(loader, model, test_10crop=True, gpu=True, iter_nu
                 inputs = Variable(inputs)
                 labels = Variable(labels)
             _, outputs = model(inputs)
-            if start_test:
-                all_output = outputs.data.float()
-                all_label = labels.data.float()
-                start_test = False
-            else:
-                all_output = torch.cat((all_output, outputs.data.float()), 0)
-                all_label = torch.cat((all_label, labels.data.float()), 0)
-    _, predict = torch.max(all_output, 1)
-    accuracy = torch.sum(torch.squeeze(predict).float() == all_label).item() / float(all_label.size()[0])
-    return accuracy
+            evaluator.update(outputs, labels)
+    return evaluator.accuracy()
 
 
 def train(config):
     ## set pre-process
-    prep_dict = {}
     prep_config = config["prep"]
+    if prep_config["jpeg_draft"]:
+        # the PIL backend decodes JPEGs straight at the smallest DCT scale still covering resize_size
+        data_list.set_draft_size(prep_config["resize_size"])
+    decode_backend = config["decode_backend"]
+    if decode_backend == "auto":
+        # the image cache and the crop cache need PIL images, accimage ones cannot go through them
+        decode_backend = data_list.select_decode_backend(
+            open(config["data"]["source"]["list_path"]).readlines(),
+            exclude=("accimage",) if config["image_cache"] > 0 or config["crop_cache"] else (),
+            out_file=config["out_file"])
+    data_list.set_decode_backend(decode_backend)
+    loader = data_list.decode_loader
+    if config["image_cache"] > 0:
+        # every loader of this run, DataLoader workers and DEV included, decodes and resizes an image once
+        data_list.set_image_cache(SharedImageCache(max_bytes=config["image_cache"] * 1024 ** 2,
+                                                   resize_size=prep_config["resize_size"], loader=loader))
+        # default_loader reads through the cache, which decodes the misses with loader
+        loader = data_list.default_loader
+    prep_dict = {}
     prep_dict["source"] = prep.image_train( \
                             resize_size=prep_config["resize_size"], \
                             crop_size=prep_config["crop_size"])
@@ -131,7 +86,7 @@ def train(config):
                             resize_size=prep_config["resize_size"], \
                             crop_size=prep_config["crop_size"])
     if prep_config["test_10crop"]:
-        prep_dict["test"] = prep.image_test_10crop( \
+        prep_dict["test"] = prep.image_test_10view( \
                             resize_size=prep_config["resize_size"], \
                             crop_size=prep_config["crop_size"])
     else:
@@ -145,51 +100,55 @@ def train(config):
     loss_params = config["loss"]
 
     ## prepare data
+    read_ahead = config["read_ahead"]
+    if config["image_shards"]:
+        # images are read pre-resized out of the memory-mapped shards written by image_shard.py
+        make_image_list = functools.partial(ShardImageList, config["image_shards"],
+                                            num_threads=config["loader_threads"],
+                                            resize_size=prep_config["resize_size"])
+        # shards are memory-mapped, there are no image files to read ahead
+        read_ahead = 0
+    else:
+        make_image_list = functools.partial(ImageList, loader=loader, num_threads=config["loader_threads"])
+        if read_ahead > 0:
+            # files read ahead by the samplers of the shuffled loaders, taken by the loaders of their workers
+            data_list.set_byte_cache(data_list.ByteCache())
     dsets = {}
     dset_loaders = {}
     data_config = config["data"]
 
     # seperate the source and validation set
     cls_source_list, cls_validation_list = sep.split_set(data_config["source"]["list_path"],
-                                                         config["network"]["params"]["class_num"])
+                                                         config["network"]["params"]["class_num"],
+                                                         mode=config["split_mode"], seed=config["split_seed"],
+                                                         manifest=config["split_mode"] == "hash")
     source_list = sep.dimension_rd(cls_source_list)
 
-    dsets["source"] = ImageList(source_list, \
+    dsets["source"] = make_image_list(source_list, \
                                 transform=prep_dict["source"])
-    dset_loaders["source"] = util_data.DataLoader(dsets["source"], \
-            batch_size=data_config["source"]["batch_size"], \
-            shuffle=True, num_workers=4)
-    dsets["target"] = ImageList(open(data_config["target"]["list_path"]).readlines(), \
+    # whole batches of indices go to the dataset, loaded on its --loader_threads threads
+    dset_loaders["source"] = data_list.batch_loader(dsets["source"], \
+            data_config["source"]["batch_size"], \
+            data_list.shuffle_sampler(dsets["source"], read_ahead), num_workers=4)
+    dsets["target"] = make_image_list(open(data_config["target"]["list_path"]).readlines(), \
                                 transform=prep_dict["target"])
-    dset_loaders["target"] = util_data.DataLoader(dsets["target"], \
-            batch_size=data_config["target"]["batch_size"], \
-            shuffle=True, num_workers=4)
-
-    if prep_config["test_10crop"]:
-        for i in range(10):
-            dsets["test"+str(i)] = ImageList(open(data_config["test"]["list_path"]).readlines(), \
-                                transform=prep_dict["test"]["val"+str(i)])
-            dset_loaders["test"+str(i)] = util_data.DataLoader(dsets["test"+str(i)], \
-                                batch_size=data_config["test"]["batch_size"], \
-                                shuffle=False, num_workers=4)
-
-            dsets["target"+str(i)] = ImageList(open(data_config["target"]["list_path"]).readlines(), \
-                                transform=prep_dict["test"]["val"+str(i)])
-            dset_loaders["target"+str(i)] = util_data.DataLoader(dsets["target"+str(i)], \
-                                batch_size=data_config["test"]["batch_size"], \
-                                shuffle=False, num_workers=4)
-    else:
-        dsets["test"] = ImageList(open(data_config["test"]["list_path"]).readlines(), \
-                                transform=prep_dict["test"])
-        dset_loaders["test"] = util_data.DataLoader(dsets["test"], \
-                                batch_size=data_config["test"]["batch_size"], \
-                                shuffle=False, num_workers=4)
-
-        dsets["target_test"] = ImageList(open(data_config["target"]["list_path"]).readlines(), \
-                                transform=prep_dict["test"])
-        dset_loaders["target_test"] = MyDataLoader(dsets["target_test"], \
-                                batch_size=data_config["test"]["batch_size"], \
-                                shuffle=False, num_workers=4)
+    dset_loaders["target"] = data_list.batch_loader(dsets["target"], \
+            data_config["target"]["batch_size"], \
+            data_list.shuffle_sampler(dsets["target"], read_ahead), num_workers=4)
+
+    # one decode per test image, with test_10crop the transform stacks the 10 views and
+    # prep.collate_views flattens them into one batch
+    dsets["test"] = make_image_list(open(data_config["test"]["list_path"]).readlines(), \
+                            transform=prep_dict["test"])
+    dset_loaders["test"] = util_data.DataLoader(dsets["test"], \
+                            batch_size=data_config["test"]["batch_size"], \
+                            shuffle=False, num_workers=4, collate_fn=prep.collate_views)
+
+    dsets["target_test"] = make_image_list(open(data_config["target"]["list_path"]).readlines(), \
+                            transform=prep_dict["test"])
+    dset_loaders["target_test"] = util_data.DataLoader(dsets["target_test"], \
+                            batch_size=data_config["test"]["batch_size"], \
+                            shuffle=False, num_workers=4, collate_fn=prep.collate_views)
 
     class_num = config["network"]["params"]["class_num"]
 
@@ -235,6 +194,10 @@ def train(config):
     lr_scheduler = lr_schedule.schedule_dict[optimizer_config["lr_type"]]
 
 
+    feature_store = None
+    if config["feature_store"]:
+        feature_store = FeatureStore(config["feature_store"], incremental=config["feature_store_incremental"])
+
     ## train
     len_train_source = len(dset_loaders["source"]) - 1
     len_train_target = len(dset_loaders["target"]) - 1
@@ -263,7 +226,7 @@ def train(config):
         # if i % loss_params["update_iter"] == loss_params["update_iter"] - 1:
         #     base_network.train(False)
         #     target_fc8_out = image_classification_predict(dset_loaders, base_network, softmax_param=config["softmax_param"])
-        #     class_weight = torch.mean(target_fc8_out, 0)
+        #     class_weight = target_fc8_out
         #     class_weight = (class_weight / torch.mean(class_weight)).cuda().view(-1)
         #     class_criterion = nn.CrossEntropyLoss(weight = class_weight)
 
@@ -355,7 +318,10 @@ def train(config):
                                              data_config["target"]["list_path"], cls_validation_list,
                                              class_num, prep_config["resize_size"],
                                              prep_config["crop_size"], data_config["target"]["batch_size"],
-                                             use_gpu)
+                                             use_gpu, single_pass=config["dev_single_pass"], feature_store=feature_store,
+                                             n_jobs=config["dev_jobs"], seed=config["dev_seed"],
+                                             estimator=config["dev_estimator"],
+                                             deterministic=config["dev_deterministic"], crop_cache=config["crop_cache"])
     print(cv_loss)
 
 
@@ -371,7 +337,32 @@ if __name__ == "__main__":
     parser.add_argument('--num_iterations', type=int, default=500, help="number of iterations")
     parser.add_argument('--snapshot_interval', type=int, default=5000, help="interval of two continuous output model")
     parser.add_argument('--output_dir', type=str, default='san', help="output directory of our model (in ../snapshot directory)")
+    parser.add_argument('--jpeg_draft', action='store_true', help="decode JPEGs at a reduced scale still covering resize_size")
+    parser.add_argument('--decode_backend', type=str, default='pil',
+                        choices=['pil', 'pil-simd', 'accimage', 'decode_jpeg', 'auto'],
+                        help="image decoder: pil, accimage, decode_jpeg or auto to benchmark them on the source list")
+    parser.add_argument('--loader_threads', type=int, default=0, help="threads loading the images of a batch in every DataLoader worker")
+    parser.add_argument('--read_ahead', type=int, default=0, help="upcoming training images read into a /dev/shm byte cache ahead of the loaders, 0 to disable")
+    parser.add_argument('--image_shards', type=str, default='', help="directory packed by image_shard.py, empty to read image files")
+    parser.add_argument('--image_cache', type=int, default=0, help="MB of decoded images shared in /dev/shm, 0 to disable")
+    parser.add_argument('--feature_store', type=str, default='', help="directory caching DEV features, empty to disable")
+    parser.add_argument('--feature_store_incremental', action='store_true',
+                        help="reuse cached DEV features line by line, so only new lines are extracted")
+    parser.add_argument('--split_mode', type=str, default='tail', choices=['tail', 'random', 'hash'],
+                        help="how the source validation split is chosen")
+    parser.add_argument('--split_seed', type=int, default=0, help="seed of the random and hash split modes")
+    parser.add_argument('--dev_seed', type=int, default=None,
+                        help="seed of the DEV train/test split and domain classifiers, the same loss for any --dev_jobs")
+    parser.add_argument('--dev_single_pass', action='store_true',
+                        help="forward every DEV set once instead of once per class, needed by --feature_store and --crop_cache")
+    parser.add_argument('--dev_jobs', type=int, default=1, help="processes fitting the DEV domain classifiers")
+    parser.add_argument('--dev_estimator', type=str, default='mlp', choices=['mlp', 'logistic', 'ulsif', 'lda'],
+                        help="importance weight estimator of DEV")
+    parser.add_argument('--dev_deterministic', action='store_true', help="extract DEV features with center crops")
+    parser.add_argument('--crop_cache', type=str, default='', help="directory caching DEV center crops, empty to disable")
     args = parser.parse_args()
+    if args.decode_backend == "accimage" and (args.image_cache > 0 or args.crop_cache):
+        parser.error("--image_cache and --crop_cache need PIL images, they cannot be used with --decode_backend accimage")
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
 
     # train config
@@ -382,6 +373,21 @@ if __name__ == "__main__":
     config["test_interval"] = args.test_interval
     config["snapshot_interval"] = args.snapshot_interval
     config["output_for_test"] = True
+    config["feature_store"] = args.feature_store
+    config["feature_store_incremental"] = args.feature_store_incremental
+    config["split_mode"] = args.split_mode
+    config["split_seed"] = args.split_seed
+    config["dev_jobs"] = args.dev_jobs
+    config["dev_single_pass"] = args.dev_single_pass
+    config["dev_seed"] = args.dev_seed
+    config["dev_estimator"] = args.dev_estimator
+    config["dev_deterministic"] = args.dev_deterministic
+    config["crop_cache"] = args.crop_cache
+    config["image_cache"] = args.image_cache
+    config["image_shards"] = args.image_shards
+    config["decode_backend"] = args.decode_backend
+    config["loader_threads"] = args.loader_threads
+    config["read_ahead"] = args.read_ahead
     config["output_path"] = "../snapshot/" + args.output_dir
     if not osp.exists(config["output_path"]):
         os.mkdir(config["output_path"])
@@ -389,7 +395,7 @@ if __name__ == "__main__":
     if not osp.exists(config["output_path"]):
         os.mkdir(config["output_path"])
 
-    config["prep"] = {"test_10crop":True, "resize_size":256, "crop_size":224}
+    config["prep"] = {"test_10crop":True, "resize_size":256, "crop_size":224, "jpeg_draft":args.jpeg_draft}
     config["loss"] = {"trade_off":1.0, "update_iter":500}
     if "AlexNet" in args.net:
         config["network"] = {"name":network.AlexNetFc, \
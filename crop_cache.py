@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import torch
+import torch.utils.data as util_data
+from data_list import ImageList, ImageIndex, decode_mode
+import pre_process as prep
+
+
+class CachedImageList(object):
+    """Dataset over preprocessed uint8 crops, a drop-in replacement of ImageList for DEV extraction.
+    Args:
+        crops (array): uint8 crops of shape [N, C, H, W], usually memory-mapped.
+        imgs (ImageIndex): labels of the crops, row i belongs to crops[i].
+        transform (callable, optional): applied to the uint8 tensor of every crop, e.g. ``prep.normalize_uint8()``.
+    """
+
+    def __init__(self, crops, imgs, transform=None):
+        self.crops = crops
+        self.imgs = imgs
+        self.transform = transform
+
+    def __getitem__(self, index):
+        img = torch.from_numpy(np.array(self.crops[index]))
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, self.imgs.target(index)
+
+    def __len__(self):
+        return len(self.imgs)
+
+
+class CropCache(object):
+    """On-disk cache of the deterministic ``image_test`` crops of image lists.
+
+    Every image list is decoded, resized and center-cropped once into ``root/<key>.npy``, a uint8 array of
+    shape [N, 3, crop_size, crop_size] keyed by the list contents and the crop geometry. Later DEV runs, on any
+    checkpoint, memory-map it and only normalize, so JPEG decoding and resizing are skipped entirely.
+    Args:
+        root (string): directory holding the cached crops.
+        resize_size (int): size images are resized to before cropping.
+        crop_size (int): size of the center crop.
+        batch_size (int): images decoded per batch while building an entry.
+        num_workers (int): decoding processes while building an entry.
+    """
+
+    def __init__(self, root, resize_size=256, crop_size=224, batch_size=64, num_workers=4):
+        self.root = root
+        self.resize_size = resize_size
+        self.crop_size = crop_size
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def key(self, image_list):
+        digest = hashlib.sha1()
+        for line in image_list:
+            digest.update(line.strip().encode("utf-8"))
+            digest.update(b"\n")
+        digest.update("{} {}".format(self.resize_size, self.crop_size).encode("utf-8"))
+        # crops decoded in draft mode or by another backend differ slightly
+        digest.update(json.dumps(decode_mode(), sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def crops(self, image_list):
+        """
+        :param image_list: list of "path label" lines
+        :return: memory-mapped uint8 crops [N, 3, crop_size, crop_size], in list order
+        """
+        path = os.path.join(self.root, self.key(image_list) + ".npy")
+        if not os.path.exists(path):
+            self.build(image_list, path)
+        return np.load(path, mmap_mode="r")
+
+    def build(self, image_list, path):
+        dsets = ImageList(image_list, transform=prep.image_test_uint8(self.resize_size, self.crop_size))
+        dset_loaders = util_data.DataLoader(dsets, batch_size=self.batch_size, shuffle=False,
+                                            num_workers=self.num_workers)
+        # written next to the entry first so a crash never leaves a half entry behind
+        fd, tmp_path = tempfile.mkstemp(suffix=".npy", dir=self.root)
+        os.close(fd)
+        crops = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8,
+                                          shape=(len(dsets), 3, self.crop_size, self.crop_size))
+        start = 0
+        for inputs, _ in dset_loaders:
+            crops[start:start + inputs.size(0)] = inputs.numpy()
+            start += inputs.size(0)
+        crops.flush()
+        del crops
+        os.rename(tmp_path, path)
+
+    def dataset(self, image_list):
+        """
+        :return: CachedImageList yielding the same normalized tensors as ImageList with prep.image_test
+        """
+        return CachedImageList(self.crops(image_list), ImageIndex(image_list), transform=prep.normalize_uint8())
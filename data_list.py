@@ -6,8 +6,19 @@ from sklearn.preprocessing import StandardScaler
 import random
 from PIL import Image
 import torch.utils.data as data
+from torch.utils.data.dataloader import default_collate
 import os
 import os.path
+import atexit
+import functools
+import hashlib
+import io
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 def make_dataset(image_list, labels):
     if labels:
@@ -21,10 +32,175 @@ def make_dataset(image_list, labels):
     return images
 
 
-def pil_loader(path):
+class ImageIndex(object):
+    """Compact replacement of the (path, label) list of make_dataset.
+
+    Paths live in one contiguous utf-8 buffer addressed by an offsets array, single labels in an int32 array
+    and multi-label targets in a 2D matrix, bit-packed when every value is 0 or 1. These are a handful of numpy
+    arrays instead of millions of Python objects, so DataLoader workers share them through fork without
+    reference counting touching, and copying, their pages.
+    Args:
+        image_list (list): lines of "path label [label ...]", or paths when labels is given.
+        labels (array, optional): label matrix of shape [N, L], row i belongs to image_list[i].
+    """
+
+    def __init__(self, image_list, labels=None):
+        if labels is not None:
+            paths = [line.strip() for line in image_list]
+            self.label = np.asarray(labels)
+            self.multi_label = "matrix"
+        else:
+            split_list = [line.split() for line in image_list]
+            paths = [val[0] for val in split_list]
+            if len(split_list) > 0 and len(split_list[0]) > 2:
+                label = np.array([[int(la) for la in val[1:]] for val in split_list], dtype=np.int32)
+                if np.all((label == 0) | (label == 1)):
+                    self.label = np.packbits(label.astype(np.uint8), axis=1)
+                    self.n_label = label.shape[1]
+                    self.multi_label = "packed"
+                else:
+                    self.label = label
+                    self.multi_label = "dense"
+            else:
+                self.label = np.array([int(val[1]) for val in split_list], dtype=np.int32)
+                self.multi_label = None
+        encoded = [path.encode("utf-8") for path in paths]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum([len(path) for path in encoded])
+        self.path_bytes = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        self._class_index = None
+
+    def path(self, index):
+        return self.path_bytes[self.offsets[index]:self.offsets[index + 1]].tobytes().decode("utf-8")
+
+    def target(self, index):
+        if self.multi_label is None:
+            return int(self.label[index])
+        if self.multi_label == "packed":
+            return np.unpackbits(self.label[index])[:self.n_label].astype(np.int64)
+        if self.multi_label == "dense":
+            return self.label[index].astype(np.int64)
+        return self.label[index, :]
+
+    def class_index(self):
+        """
+        :return: dict from class to the int64 array of its rows, in list order, built once with one argsort
+        """
+        if self._class_index is None:
+            assert self.multi_label is None, "the class index needs one label per image"
+            order = np.argsort(self.label, kind="mergesort")
+            classes, start = np.unique(self.label[order], return_index=True)
+            self._class_index = dict(zip(classes.tolist(), np.split(order, start[1:])))
+        return self._class_index
+
+    def __getitem__(self, index):
+        return self.path(index), self.target(index)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class ByteCache(object):
+    """Bounded cache of raw image files in a RAM-backed directory, shared by the processes of a run.
+
+    ReadAheadSampler fills it from the main process and the loaders of every DataLoader worker take the files
+    out of it as they decode the images, so no worker waits on the storage for a file read ahead. Every file is
+    written atomically and removed once read, since an image is decoded once per epoch.
+    Args:
+        root (string, optional): directory of the files, by default a fresh one in /dev/shm removed at exit.
+        max_bytes (int): budget, the files read ahead the longest ago are dropped first when it is exceeded.
+    """
+
+    def __init__(self, root=None, max_bytes=256 * 1024 ** 2):
+        if root is None:
+            root = tempfile.mkdtemp(prefix="dev_read_ahead_", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+            atexit.register(shutil.rmtree, root, True)
+        elif not os.path.exists(root):
+            os.makedirs(root)
+        self.root = root
+        self.max_bytes = max_bytes
+        # files written by this process, with their size, some of them already taken by the loaders
+        self.used = 0
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+    def path(self, image_path):
+        return os.path.join(self.root, hashlib.sha1(image_path.encode("utf-8")).hexdigest())
+
+    def put(self, image_path, data):
+        if len(data) > self.max_bytes:
+            return
+        entry = self.path(image_path)
+        with self.lock:
+            if self.used + len(data) > self.max_bytes:
+                # files taken by the loaders no longer count
+                for name in [name for name in self.files if not os.path.exists(name)]:
+                    self.used -= self.files.pop(name)
+            while self.used + len(data) > self.max_bytes:
+                name, size = self.files.popitem(last=False)
+                try:
+                    os.remove(name)
+                except OSError:
+                    pass
+                self.used -= size
+            self.used -= self.files.pop(entry, 0)
+            self.files[entry] = len(data)
+            self.used += len(data)
+        # written to a temporary file first so a loader never reads half a file
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.root)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(tmp_path, entry)
+
+    def pop(self, image_path):
+        """
+        :return: bytes of the file read ahead for image_path, or None, the entry is removed
+        """
+        entry = self.path(image_path)
+        try:
+            with open(entry, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        try:
+            os.remove(entry)
+        except OSError:
+            # taken by another loader meanwhile
+            pass
+        return data
+
+
+_byte_cache = None
+
+
+def set_byte_cache(byte_cache):
+    """
+    Make the loaders read files through byte_cache, a ByteCache filled by ReadAheadSampler. Install it before
+    the DataLoader workers start, they inherit it. None goes back to opening every file
+    """
+    global _byte_cache
+    _byte_cache = byte_cache
+
+
+def open_image_file(path):
+    """
+    :return: binary file object of path, served from the byte cache when the file was read ahead
+    """
+    if _byte_cache is not None:
+        data = _byte_cache.pop(path)
+        if data is not None:
+            return io.BytesIO(data)
+    return open(path, 'rb')
+
+
+def pil_loader(path, draft_size=None):
     # open path as file to avoid ResourceWarning (https://github.com/python-pillow/Pillow/issues/835)
-    with open(path, 'rb') as f:
+    with open_image_file(path) as f:
         with Image.open(f) as img:
+            if draft_size is not None:
+                # JPEG draft mode: decode at the smallest 1/2, 1/4 or 1/8 DCT scale still at least
+                # draft_size on both sides, a no-op for other formats
+                img.draft('RGB', (draft_size, draft_size))
             return img.convert('RGB')
 
 
@@ -37,12 +213,155 @@ def accimage_loader(path):
         return pil_loader(path)
 
 
-def default_loader(path):
-    #from torchvision import get_image_backend
-    #if get_image_backend() == 'accimage':
-    #    return accimage_loader(path)
-    #else:
+def decode_jpeg_loader(path):
+    from torchvision.io import ImageReadMode, decode_jpeg
+    with open_image_file(path) as f:
+        data = torch.from_numpy(np.frombuffer(f.read(), dtype=np.uint8).copy())
+    try:
+        img = decode_jpeg(data, mode=ImageReadMode.RGB)
+    except RuntimeError:
+        # not a JPEG
         return pil_loader(path)
+    # uint8 tensor [3, H, W], handed on as a PIL image since the prep pipelines start with PIL transforms
+    return Image.fromarray(img.permute(1, 2, 0).numpy())
+
+
+def is_pil_simd():
+    # Pillow-SIMD installs as PIL with a ".postN" version suffix
+    import PIL
+    return ".post" in getattr(PIL, "__version__", "")
+
+
+PIL_BACKEND = "pil-simd" if is_pil_simd() else "pil"
+
+decode_backends = OrderedDict()
+
+
+def register_decode_backend(name, loader):
+    """
+    Make loader, a function from an image path to an RGB image, available as the decode backend name,
+    replacing the backend already registered under that name
+    """
+    decode_backends[name] = loader
+
+
+register_decode_backend(PIL_BACKEND, pil_loader)
+try:
+    import accimage
+    register_decode_backend("accimage", accimage_loader)
+except ImportError:
+    pass
+try:
+    from torchvision.io import decode_jpeg
+    register_decode_backend("decode_jpeg", decode_jpeg_loader)
+except ImportError:
+    pass
+
+
+_decode_backend = PIL_BACKEND
+
+
+def set_decode_backend(name):
+    """
+    Make decode_loader, and so default_loader, decode with the registered backend name,
+    "pil" stands for Pillow-SIMD when it is the installed PIL. A backend missing on this host falls back to PIL
+    :return: name of the backend in use
+    """
+    global _decode_backend
+    if name == "pil":
+        name = PIL_BACKEND
+    if name not in decode_backends:
+        print("decode backend {} is not available on this host ({}), using {}".format(
+            name, ", ".join(decode_backends.keys()), PIL_BACKEND))
+        name = PIL_BACKEND
+    _decode_backend = name
+    return name
+
+
+_draft_size = None
+
+
+def set_draft_size(draft_size):
+    """
+    Make the PIL backend decode JPEGs in draft mode at the smallest DCT scale still covering draft_size,
+    None to decode them at full resolution
+    """
+    global _draft_size
+    _draft_size = draft_size
+    if draft_size is None:
+        register_decode_backend(PIL_BACKEND, pil_loader)
+    else:
+        register_decode_backend(PIL_BACKEND, functools.partial(pil_loader, draft_size=draft_size))
+
+
+def decode_mode():
+    """
+    :return: json serializable description of how decode_loader decodes, part of the key of everything
+    cached from decoded images
+    """
+    mode = {"decode_backend": _decode_backend}
+    if _decode_backend == PIL_BACKEND and _draft_size is not None:
+        mode["draft_size"] = _draft_size
+    return mode
+
+
+def decode_loader(path):
+    return decode_backends[_decode_backend](path)
+
+
+def select_decode_backend(image_list, sample_size=32, exclude=(), out_file=None):
+    """
+    Time every registered backend on a random sample of image_list and pick the fastest
+    :param image_list: list of "path label" lines, usually the list about to be trained on
+    :param sample_size: images decoded by every backend
+    :param exclude: names of backends not to consider, e.g. accimage when PIL images are needed
+    :param out_file: optional log file receiving the timings
+    :return: name of the fastest backend, a backend failing on the sample is left out, PIL_BACKEND when all fail
+    """
+    paths = [line.split()[0] for line in random.sample(list(image_list), min(sample_size, len(image_list)))]
+    # read every file once first so the first backend does not pay for the disk
+    for path in paths:
+        with open(path, 'rb') as f:
+            f.read()
+    timings = OrderedDict()
+    for name, loader in decode_backends.items():
+        if name in exclude:
+            continue
+        start = time.time()
+        try:
+            for path in paths:
+                loader(path)
+        except Exception as e:
+            print("decode backend {} failed: {}".format(name, e))
+            continue
+        timings[name] = time.time() - start
+    # every backend failing on the sample leaves PIL, whose errors the loaders report as usual
+    best = min(timings, key=timings.get) if timings else PIL_BACKEND
+    log_str = "decode backend: {} ({})".format(best, ", ".join(
+        "{} {:.1f} ms/image".format(name, 1000.0 * timing / len(paths)) for name, timing in timings.items()))
+    if out_file is not None:
+        out_file.write(log_str + "\n")
+        out_file.flush()
+    print(log_str)
+    return best
+
+
+_image_cache = None
+
+
+def set_image_cache(image_cache):
+    """
+    Make default_loader, and so every ImageList built with it, read images through image_cache,
+    e.g. an image_cache.SharedImageCache. None goes back to decoding every time
+    """
+    global _image_cache
+    _image_cache = image_cache
+
+
+def default_loader(path):
+    if _image_cache is not None:
+        return _image_cache(path)
+    return decode_loader(path)
 
 
 class ImageList(object):
@@ -60,15 +379,17 @@ class ImageList(object):
         target_transform (callable, optional): A function/transform that takes in the
             target and transforms it.
         loader (callable, optional): A function to load an image given its path.
+        num_threads (int): threads loading the images of a batch fetched with a list of indices, 0 to load
+            them one after the other.
      Attributes:
         classes (list): List of the class names.
         class_to_idx (dict): Dict with items (class_name, class_index).
-        imgs (list): List of (image path, class_index) tuples
+        imgs (ImageIndex): (image path, class_index) of every image
     """
 
     def __init__(self, image_list, labels=None, transform=None, target_transform=None,
-                 loader=default_loader):
-        imgs = make_dataset(image_list, labels)
+                 loader=default_loader, num_threads=0):
+        imgs = ImageIndex(image_list, labels)
         if len(imgs) == 0:
             raise(RuntimeError("Found 0 images in subfolders of: " + root + "\n"
                                "Supported image extensions are: " + ",".join(IMG_EXTENSIONS)))
@@ -77,14 +398,22 @@ class ImageList(object):
         self.transform = transform
         self.target_transform = target_transform
         self.loader = loader
+        self.num_threads = num_threads
+        self.pool = None
 
     def __getitem__(self, index):
         """
         Args:
-            index (int): Index
+            index (int or list): Index, or the indices of a whole batch, as batch_loader fetches them
         Returns:
-            tuple: (image, target) where target is class_index of the target class.
+            tuple: (image, target) where target is class_index of the target class, for a list of indices
+                the images and targets of the batch collated as the default DataLoader collate does.
         """
+        if isinstance(index, (list, tuple)):
+            return default_collate(self.__getitems__(index))
+        return self.load(index)
+
+    def load(self, index):
         path, target = self.imgs[index]
         img = self.loader(path)
         if self.transform is not None:
@@ -94,9 +423,152 @@ class ImageList(object):
 
         return img, target
 
+    def __getitems__(self, indices):
+        """
+        Batch fetch, used by __getitem__ for a list of indices and by the DataLoader of torch >= 2.0.
+        Args:
+            indices (list): indices of the batch.
+        Returns:
+            list: (image, target) of every index, in order.
+        """
+        if self.num_threads <= 0 or len(indices) <= 1:
+            return [self.load(index) for index in indices]
+        if self.pool is None or self.pool_pid != os.getpid():
+            # one pool per process, threads of the parent do not survive the fork of the DataLoader workers
+            self.pool = ThreadPoolExecutor(self.num_threads)
+            self.pool_pid = os.getpid()
+        # file reads, decoding and most transforms release the GIL, so the images of a batch load concurrently
+        return list(self.pool.map(self.load, indices))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["pool"] = None
+        return state
+
+    def read_ahead(self, index):
+        """
+        Read the file of image index into the byte cache before it is decoded, nothing to do without a byte
+        cache or when the image cache already holds the decoded image
+        Args:
+            index (int): Index
+        """
+        if _byte_cache is None:
+            return
+        path = self.imgs.path(index)
+        if _image_cache is not None and _image_cache.contains(path):
+            return
+        with open(path, 'rb') as f:
+            data = f.read()
+        _byte_cache.put(path, data)
+
     def __len__(self):
         return len(self.imgs)
 
+    def class_indices(self, cls):
+        """
+        Args:
+            cls (int): class index.
+        Returns:
+            array: indices of the images of class cls, in list order.
+        """
+        return self.imgs.class_index().get(cls, np.zeros(0, dtype=np.int64))
+
+    def subset_by_class(self, cls):
+        """
+        Args:
+            cls (int): class index.
+        Returns:
+            Dataset: the images of class cls only, without scanning the others.
+        """
+        return data.Subset(self, self.class_indices(cls))
+
+
+class ClassSampler(data.Sampler):
+    """Samples the images of one class of an ImageList only.
+    Args:
+        data_source (ImageList): dataset to sample from.
+        cls (int): class to sample.
+        shuffle (bool): sample the class in a random order instead of list order.
+    """
+
+    def __init__(self, data_source, cls, shuffle=False):
+        self.indices = data_source.class_indices(cls)
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        indices = self.indices
+        if self.shuffle:
+            indices = indices[np.random.permutation(len(indices))]
+        return iter(indices.tolist())
+
+    def __len__(self):
+        return len(self.indices)
+
+class ReadAheadSampler(data.Sampler):
+    """Wraps a sampler and reads the files of the next indices ahead of the DataLoader.
+
+    The order of an epoch is drawn from the wrapped sampler up front. While the DataLoader consumes it, a
+    thread pool of the main process reads the files ``depth`` positions ahead through ``data_source.read_ahead``
+    into the ByteCache installed with set_byte_cache, so with a shuffled order on high latency storage, such as
+    NFS, the loaders of the DataLoader workers find the bytes in memory instead of waiting on a random read.
+    Args:
+        sampler (Sampler): sampler giving the order, e.g. ``RandomSampler(data_source)``.
+        data_source (ImageList): dataset the indices belong to.
+        depth (int): number of upcoming files read ahead.
+        num_threads (int): concurrent reads.
+    """
+
+    def __init__(self, sampler, data_source, depth=64, num_threads=8):
+        self.sampler = sampler
+        self.data_source = data_source
+        self.depth = depth
+        self.num_threads = num_threads
+
+    def read(self, index):
+        try:
+            self.data_source.read_ahead(index)
+        except (IOError, OSError):
+            # reported by the loader when the image is decoded
+            pass
+
+    def __iter__(self):
+        order = list(self.sampler)
+        pool = ThreadPoolExecutor(self.num_threads)
+        try:
+            for index in order[:self.depth]:
+                pool.submit(self.read, index)
+            for position, index in enumerate(order):
+                if position + self.depth < len(order):
+                    pool.submit(self.read, order[position + self.depth])
+                yield index
+        finally:
+            pool.shutdown(wait=False)
+
+    def __len__(self):
+        return len(self.sampler)
+
+
+def shuffle_sampler(data_source, read_ahead=0):
+    """
+    Sampler of a shuffled DataLoader, the same as shuffle=True
+    :param read_ahead: number of upcoming files read ahead by a ReadAheadSampler, 0 not to read ahead
+    """
+    sampler = data.RandomSampler(data_source)
+    if read_ahead > 0:
+        sampler = ReadAheadSampler(sampler, data_source, depth=read_ahead)
+    return sampler
+
+
+def batch_loader(dataset, batch_size, sampler, num_workers=4):
+    """
+    DataLoader handing whole batches of indices to dataset[indices], so an ImageList loads the images of a batch
+    on its threads whatever the torch version, __getitems__ is only called by the DataLoader from torch 2.0 on
+    :param sampler: sampler of single indices, e.g. shuffle_sampler(dataset)
+    :return: DataLoader yielding the same batches as DataLoader(dataset, batch_size, sampler=sampler)
+    """
+    return data.DataLoader(dataset, batch_size=None, num_workers=num_workers,
+                           sampler=data.BatchSampler(sampler, batch_size, drop_last=False))
+
 class ImageValueList(object):
     """A generic data loader where the images are arranged in this way: ::
         root/dog/xxx.png
@@ -115,12 +587,12 @@ class ImageValueList(object):
      Attributes:
         classes (list): List of the class names.
         class_to_idx (dict): Dict with items (class_name, class_index).
-        imgs (list): List of (image path, class_index) tuples
+        imgs (ImageIndex): (image path, class_index) of every image
     """
 
     def __init__(self, image_list, labels=None, transform=None, target_transform=None,
                  loader=default_loader):
-        imgs = make_dataset(image_list, labels)
+        imgs = ImageIndex(image_list, labels)
         if len(imgs) == 0:
             raise(RuntimeError("Found 0 images in subfolders of: " + root + "\n"
                                "Supported image extensions are: " + ",".join(IMG_EXTENSIONS)))
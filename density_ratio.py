@@ -0,0 +1,79 @@
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+from sklearn.kernel_approximation import RBFSampler
+
+
+def classifier_weight(domain_classifier, source_feature, target_feature, validation_feature):
+    """
+    Fit a probabilistic domain classifier and turn it into importance weights, like get_weight does with the MLP
+    :param domain_classifier: sklearn classifier with predict_proba
+    :param source_feature: shape [N_tr, d], features from training set
+    :param target_feature: shape [N_te, d], features from test set
+    :param validation_feature: shape [N_v, d], features from validation set
+    :return: shape [N_v, 1]
+    """
+    N_s = source_feature.shape[0]
+    N_t = target_feature.shape[0]
+    all_feature = np.concatenate((source_feature, target_feature))
+    all_label = np.asarray([1] * N_s + [0] * N_t, dtype=np.int32)  # 1->source 0->target
+    domain_classifier.fit(all_feature, all_label)
+    domain_out = domain_classifier.predict_proba(validation_feature)
+    return domain_out[:, :1] / domain_out[:, 1:] * N_s * 1.0 / N_t  # (Ntr/Nts)*(1-M(fv))/M(fv)
+
+
+def logistic_weight(source_feature, target_feature, validation_feature, decay=1e-3):
+    """
+    L2-regularized logistic regression solved with LBFGS
+    :param decay: L2 penalty, the inverse of sklearn's C
+    """
+    domain_classifier = LogisticRegression(C=1.0 / decay, solver='lbfgs', max_iter=1000)
+    return classifier_weight(domain_classifier, source_feature, target_feature, validation_feature)
+
+
+def lda_weight(source_feature, target_feature, validation_feature):
+    """
+    Linear discriminant: one Gaussian per domain with a shared covariance, shrunk so it stays invertible
+    when there are fewer samples than feature dimensions
+    """
+    domain_classifier = LinearDiscriminantAnalysis(solver='lsqr', shrinkage='auto')
+    return classifier_weight(domain_classifier, source_feature, target_feature, validation_feature)
+
+
+def median_gamma(feature, max_sample=1000):
+    """
+    RBF gamma from the median heuristic, 1 / median squared distance between rows
+    """
+    if feature.shape[0] > max_sample:
+        feature = feature[np.sort(np.random.choice(feature.shape[0], max_sample, replace=False))]
+    feature = np.asarray(feature, dtype=np.float64)
+    sq_norm = np.sum(feature ** 2, axis=1)
+    distance = sq_norm[:, None] + sq_norm[None, :] - 2 * feature.dot(feature.T)
+    median = np.median(distance[np.triu_indices(feature.shape[0], 1)])
+    return 1.0 / max(median, 1e-12)
+
+
+def ulsif_weight(source_feature, target_feature, validation_feature, n_components=512, gamma=None, decay=1e-3,
+                 random_state=None):
+    """
+    unconstrained Least-Squares Importance Fitting over random Fourier features of an RBF kernel.
+    w(f) = phi(f)^T alpha directly models p_target(f) / p_source(f), which is what the classifier weights estimate,
+    and alpha = (H + decay * I)^-1 h has a closed form
+    :param n_components: number of random Fourier features
+    :param gamma: RBF kernel width, median heuristic by default
+    :param decay: ridge penalty on alpha
+    """
+    if gamma is None:
+        gamma = median_gamma(np.concatenate((source_feature, target_feature)))
+    rff = RBFSampler(gamma=gamma, n_components=n_components, random_state=random_state)
+    rff.fit(source_feature)
+    phi_source = rff.transform(source_feature)
+    phi_target = rff.transform(target_feature)
+    H = phi_source.T.dot(phi_source) / phi_source.shape[0]
+    h = phi_target.mean(axis=0)
+    alpha = np.linalg.solve(H + decay * np.eye(n_components), h)
+    weight = rff.transform(validation_feature).dot(alpha)
+    return np.maximum(weight, 0).reshape(-1, 1)
+
+
+estimator_dict = {"logistic": logistic_weight, "ulsif": ulsif_weight, "lda": lda_weight}
@@ -6,11 +6,17 @@ import psutil
 import gc
 import os
 import numpy as np
-from sklearn.neural_network import MLPClassifier
 from sklearn.model_selection import train_test_split
+from joblib import Parallel, delayed
+from domain_classifier import fit_domain_classifier
 import torch.utils.data as util_data
 from data_list import ImageList
 import pre_process as prep
+import seperate_data
+import subsample
+import dev_error
+import feature_extractor
+import density_ratio
 import torch.nn as nn
 from torch.autograd import Variable
 
@@ -37,17 +43,22 @@ def get_dev_risk(weight, error):
 
 
 def get_weight(source_feature, target_feature,
-               validation_feature):  # 这三个feature根据类别不同，是不一样的. source与target这里需注意一下数据量threshold 2倍的事儿
+               validation_feature, n_jobs=1, random_state=None, estimator="mlp"):  # 这三个feature根据类别不同，是不一样的. source与target这里需注意一下数据量threshold 2倍的事儿
     """
     :param source_feature: shape [N_tr, d], features from training set
     :param target_feature: shape [N_te, d], features from test set
     :param validation_feature: shape [N_v, d], features from validation set
+    :param n_jobs: number of worker processes fitting the weight decay sweep, 1 fits them one after another
+    :param random_state: seed for the train/test split and the classifiers
+    :param estimator: "mlp" for the MLP domain classifier, or a key of density_ratio.estimator_dict
     :return:
     """
+    if estimator != "mlp":
+        return density_ratio.estimator_dict[estimator](source_feature, target_feature, validation_feature)
     N_s, d = source_feature.shape
     N_t, _d = target_feature.shape
     if float(N_s) / N_t > 2:
-        source_feature = random_select_src(source_feature, target_feature)
+        source_feature = subsample.random_select_src(source_feature, target_feature)
     else:
         source_feature = source_feature.copy()
 
@@ -60,22 +71,22 @@ def get_weight(source_feature, target_feature,
     # print(all_feature.shape)
     # print(all_label.shape)
     feature_for_train, feature_for_test, label_for_train, label_for_test = train_test_split(all_feature, all_label,
-                                                                                            train_size=0.8)
+                                                                                            train_size=0.8,
+                                                                                            random_state=random_state)
 
     # here is train, test split, concatenating the data from source and target
 
     decays = [1e-1, 3e-2, 1e-2, 3e-3, 1e-3, 3e-4, 1e-4, 3e-5, 1e-5]
-    val_acc = []
-    domain_classifiers = []
-
-    for decay in decays:
-        domain_classifier = MLPClassifier(hidden_layer_sizes=(d, d, 2), activation='relu', alpha=decay, max_iter=10000)
-        domain_classifier.fit(feature_for_train, label_for_train)
-        output = domain_classifier.predict(feature_for_test)
-        acc = np.mean((label_for_test == output).astype(np.float32))
-        val_acc.append(acc)
-        domain_classifiers.append(domain_classifier)
-        # print('decay is %s, val acc is %s' % (decay, acc))
+
+    if n_jobs == 1:
+        results = [fit_domain_classifier(decay, feature_for_train, label_for_train, feature_for_test, label_for_test,
+                                         random_state) for decay in decays]
+    else:
+        results = Parallel(n_jobs=n_jobs)(delayed(fit_domain_classifier)(decay, feature_for_train, label_for_train,
+                                                                         feature_for_test, label_for_test,
+                                                                         random_state) for decay in decays)
+    domain_classifiers = [result[0] for result in results]
+    val_acc = [result[1] for result in results]
 
     index = val_acc.index(max(val_acc))
 
@@ -90,89 +101,84 @@ def get_weight(source_feature, target_feature,
     # correspond to (Ntr/Nts)*(1-M(fv))/M(fv), M(fv) just indicate whether 0 or 1, meaning from source or target
 
 
-def random_select_src(source_feature, target_feature):
-    # done with debugging
-    """
-    Select at most 2*Ntr data from source feature randomly
-    :param source_feature: shape [N_tr, d], features from training set
-    :param target_feature: shape [N_te, d], features from test set
-    :return:
-    """
-    N_s, d = source_feature.shape
-    N_t, _d = target_feature.shape
-    items = [i for i in range(1, N_s)]
-    random_list = random.sample(items, 2 * N_t - 1)
-    new_source_feature = source_feature[0].reshape(1, d)
-    # print(N_t) # 9
-    # print(N_s) # 24
-    # print(len(random_list)) # 17
-    # print(random_list) # [11, 23, 8, 21, 16, 2, 14, 12, 22, 3, 18, 13, 10, 20, 1, 7, 19]
-    # print(len(source_feature))# 24
-    for i in range(2 * N_t - 1):
-        # randome_list[i] have list out of range problem
-        # print(i)
-        # print(random_list[i])
-        new_source_feature = np.concatenate((new_source_feature, source_feature[random_list[i]].reshape(1, d)))
-
-    print("random_select:")
-    print(new_source_feature.shape)
-    return new_source_feature
-
-
 def predict_loss(cls, y_pre):
     # done with debugging works fine
     """
-    Calculate the cross entropy loss for prediction of one picture
+    Calculate the cross entropy loss for prediction of one picture, use dev_error.batch_error for whole batches
     :param cls:
     :param y_pre:
     :return:
     """
-    cls_torch = np.full(1, cls)
-    pre_cls_torch = y_pre.double()
-    target = torch.from_numpy(cls_torch).cuda()
-    entropy = nn.CrossEntropyLoss()
-    return entropy(pre_cls_torch, target)
+    return dev_error.batch_error(y_pre, cls).mean()
 
 
 def get_label_list(target_list, predict_network, resize_size, crop_size, batch_size, use_gpu):
     """
-    Return the target list with pesudolabel
+    Pesudolabel the target list
     :param target_list: list conatinging all target file path and a wrong label
     :param predict_network: network to perdict label for target image
     :param resize_size:
     :param crop_size:
     :param batch_size:
-    :return:
+    :return: image paths [N] and their pesudolabels, an int32 numpy array [N], in list order
     """
-    label_list = []
-    dsets_tar = ImageList(target_list, transform=prep.image_train(resize_size=resize_size, crop_size=crop_size))
-    dset_loaders_tar = util_data.DataLoader(dsets_tar, batch_size=batch_size, shuffle=False, num_workers=4)
-    len_train_target = len(dset_loaders_tar)
-    iter_target = iter(dset_loaders_tar)
-    count = 0
-    for i in range(len_train_target):
-        input_tar, label_tar = iter_target.next()
-        if use_gpu:
-            input_tar, label_tar = Variable(input_tar).cuda(), Variable(label_tar).cuda()
-        else:
-            input_tar, label_tar = Variable(input_tar), Variable(label_tar)
-        _, predict_score = predict_network(input_tar)
-        _, predict_label = torch.max(predict_score, 1)
-        for num in range(len(predict_label.cpu())):
-            if target_list[count][-3] == ' ':
-                ind = -2
-            else:
-                ind = -3
-            label_list.append(target_list[count][:ind])
-            label_list[count] = label_list[count] + str(predict_label[num].cpu().numpy()) + "\n"
-            count += 1
-    return label_list
+    prep_dict = prep.image_train(resize_size=resize_size, crop_size=crop_size)
+    # one device to host copy per batch, labels stay an array
+    forward = feature_extractor.forward_pair(predict_network, predict_network)
+    label_list = [score.argmax(axis=1) for _, score, _ in
+                  feature_extractor.iterate_feature(forward, target_list, prep_dict, batch_size, use_gpu,
+                                                    [predict_network])]
+    return seperate_data.list_path(target_list), np.concatenate(label_list).astype(np.int32)
 
 
-def cross_validation_loss(feature_network, predict_network, src_cls_list, target_path, val_cls_list, class_num,
-                          resize_size, crop_size, batch_size, use_gpu):
+def pseudo_label_feature(feature_network, predict_network, target_list, prep_dict, batch_size, use_gpu,
+                         feature_store=None, transform_config=None):
     """
-    Main function for computing the CV loss
+    Pseudo-label the target set and extract its features in the same pass, so the target is only decoded once
+    :param target_list: list conatinging all target file path and a wrong label
+    :param feature_store: optional feature_store.FeatureStore, the key does not depend on the pseudo labels
+    :return: target features [N, d] and int32 pesudolabels [N], in list order
+    """
+    tar_feature, tar_score, _ = extract_feature(feature_network, predict_network, target_list, prep_dict, batch_size,
+                                                use_gpu, feature_store, transform_config)
+    return tar_feature, np.argmax(tar_score, axis=1).astype(np.int32)
+
+
+def extract_feature(feature_network, predict_network, image_list, prep_dict, batch_size, use_gpu,
+                    feature_store=None, transform_config=None):
+    """
+    Run an image list through the networks exactly once, features and scores come from the same forward
+    :param feature_network: network whose first output is the feature
+    :param predict_network: network whose second output is the prediction score
+    :param image_list: list of "path label" lines
+    :param prep_dict: transform applied to every image
+    :param batch_size:
+    :param use_gpu:
+    :param feature_store: optional feature_store.FeatureStore, the backbone is skipped on a hit
+    :param transform_config: json serializable description of prep_dict, part of the store key
+    :return: features [N, d], prediction scores [N, C] and labels [N] as numpy arrays, in list order
+    """
+    return feature_extractor.extract_feature(feature_extractor.forward_pair(feature_network, predict_network),
+                                             [feature_network, predict_network], image_list, prep_dict, batch_size,
+                                             use_gpu, feature_store, transform_config)
+
+
+def iterate_feature(feature_network, predict_network, image_list, prep_dict, batch_size, use_gpu):
+    """
+    Same as extract_feature, but yields one batch of numpy (features, prediction scores, labels) at a time
+    """
+    return feature_extractor.iterate_feature(feature_extractor.forward_pair(feature_network, predict_network),
+                                             image_list, prep_dict, batch_size, use_gpu,
+                                             [feature_network, predict_network])
+
+
+def single_pass_cross_validation_loss(feature_network, predict_network, src_cls_list, target_path, val_cls_list,
+                                      class_num, resize_size, crop_size, batch_size, use_gpu,
+                                      error_type="cross_entropy", feature_store=None, n_jobs=1, seed=None,
+                                      estimator="mlp", deterministic=False, crop_cache=None):
+    """
+    Same as cross_validation_loss, but the source, target and validation sets are each decoded and forwarded
+    once, then split into per-class buckets in memory
     :param feature_network:
     :param predict_network:
     :param src_cls_list:
@@ -182,111 +188,160 @@ def cross_validation_loss(feature_network, predict_network, src_cls_list, target
     :param resize_size:
     :param crop_size:
     :param batch_size:
+    :param error_type: key of dev_error.error_dict
+    :param feature_store: optional feature_store.FeatureStore caching the extracted features
+    :param n_jobs: worker processes fitting the domain classifiers of get_weight
+    :param seed: random_state of get_weight
+    :param estimator: importance weight estimator of get_weight
+    :param deterministic: extract with the center crop of prep.image_test instead of random training crops
+    :param crop_cache: optional directory caching the preprocessed uint8 crops, implies deterministic
     :return:
     """
     target_list_no_label = open(target_path).readlines()
-    tar_cls_list = []
     cross_val_loss = 0
 
+    prep_dict, transform_config = feature_extractor.dev_transform(resize_size, crop_size, deterministic, crop_cache)
     # add pesudolabel for target data
-    target_list = get_label_list(target_list_no_label, predict_network, resize_size, crop_size, batch_size, use_gpu)
+    tar_feature, tar_label = pseudo_label_feature(feature_network, predict_network, target_list_no_label, prep_dict,
+                                                  batch_size, use_gpu, feature_store, transform_config)
+    if feature_store is None:
+        # get_weight never uses more than 2 source rows per target row of a class, so only that many
+        # are kept while the source set is extracted
+        reservoir = subsample.ClassReservoir(2 * np.bincount(tar_label, minlength=class_num))
+        for feature, _, label in iterate_feature(feature_network, predict_network,
+                                                 seperate_data.dimension_rd(src_cls_list), prep_dict, batch_size,
+                                                 use_gpu):
+            reservoir.update(feature, label)
+        src_feature, src_label = reservoir.result()
+    else:
+        src_feature, _, src_label = extract_feature(feature_network, predict_network,
+                                                    seperate_data.dimension_rd(src_cls_list), prep_dict,
+                                                    batch_size, use_gpu, feature_store, transform_config)
+    val_feature, val_score, val_label = extract_feature(feature_network, predict_network,
+                                                        seperate_data.dimension_rd(val_cls_list), prep_dict,
+                                                        batch_size, use_gpu, feature_store, transform_config)
 
+    # per-sample error of every validation image against its own class
+    val_error = dev_error.batch_error(torch.from_numpy(np.array(val_score)), val_label, error_type).numpy()
 
     # seperate the class
-    for i in range(class_num):
-        tar_cls_list.append([j for j in target_list if int(j.split(" ")[1].replace("\n", "")) == i])
-    prep_dict = prep.image_train(resize_size=resize_size, crop_size=crop_size)
-    # load different class's image
+    src_group = seperate_data.group_by_class(src_label, class_num)
+    tar_group = seperate_data.group_by_class(tar_label, class_num)
+    val_group = seperate_data.group_by_class(val_label, class_num)
     for cls in range(class_num):
-        dsets_src = ImageList(src_cls_list[cls], transform=prep_dict)
-        dset_loaders_src = util_data.DataLoader(dsets_src, batch_size=batch_size, shuffle=True, num_workers=4)
-
-        dsets_tar = ImageList(tar_cls_list[cls], transform=prep_dict)
-        dset_loaders_tar = util_data.DataLoader(dsets_tar, batch_size=batch_size, shuffle=True, num_workers=4)
-
-        dsets_val = ImageList(val_cls_list[cls], transform=prep_dict)
-        dset_loaders_val = util_data.DataLoader(dsets_val, batch_size=batch_size, shuffle=True, num_workers=4)
-
-        # prepare source feature
-        iter_src = iter(dset_loaders_src)
-        src_input = iter_src.next()[0]
-        if use_gpu:
-            src_input = Variable(src_input).cuda()
-        else:
-            src_input = Variable(src_input)
-        src_feature, _ = feature_network(src_input)
-        src_feature_de = src_feature.detach().cpu().numpy()
-        for count_src in range(len(dset_loaders_src) - 1):
+        src_index, tar_index, val_index = src_group[cls], tar_group[cls], val_group[cls]
+        if len(src_index) == 0 or len(tar_index) == 0 or len(val_index) == 0:
+            print('class {} has an empty source, target or validation bucket, skipped'.format(cls))
+            continue
+        weight = get_weight(src_feature[src_index], tar_feature[tar_index], val_feature[val_index], n_jobs, seed,
+                            estimator)
+        cross_val_loss = cross_val_loss + get_dev_risk(weight, val_error[val_index]) / class_num
+
+    return cross_val_loss
+
+
+def cross_validation_loss(feature_network, predict_network, src_cls_list, target_path, val_cls_list, class_num,
+                          resize_size, crop_size, batch_size, use_gpu, single_pass=False,
+                          error_type="cross_entropy", feature_store=None, n_jobs=1, seed=None, estimator="mlp",
+                          deterministic=False, crop_cache=None):
+    """
+    Main function for computing the CV loss
+    :param feature_network:
+    :param predict_network:
+    :param src_cls_list:
+    :param target_path:
+    :param val_cls_list:
+    :param class_num:
+    :param resize_size:
+    :param crop_size:
+    :param batch_size:
+    :param single_pass: forward every set once instead of building 3 loaders per class
+    :param error_type: key of dev_error.error_dict
+    :param feature_store: optional feature_store.FeatureStore, only used by the single pass mode
+    :param n_jobs: worker processes fitting the domain classifiers of get_weight
+    :param seed: random_state of get_weight
+    :param estimator: "mlp", "logistic", "ulsif" or "lda", see get_weight
+    :param deterministic: extract with the center crop of prep.image_test instead of random training crops
+    :param crop_cache: optional directory caching the preprocessed uint8 crops, only used by the single pass mode
+    :return:
+    """
+    if single_pass:
+        return single_pass_cross_validation_loss(feature_network, predict_network, src_cls_list, target_path,
+                                                 val_cls_list, class_num, resize_size, crop_size, batch_size,
+                                                 use_gpu, error_type, feature_store, n_jobs, seed, estimator,
+                                                 deterministic, crop_cache)
+
+    target_list_no_label = open(target_path).readlines()
+    cross_val_loss = 0
+    # the per-class loaders below decode the images themselves, so crop_cache does not apply
+    prep_dict, _ = feature_extractor.dev_transform(resize_size, crop_size, deterministic)
+
+    # add pesudolabel for target data, the features of this pass are reused for every class
+    tar_feature_all, tar_label = pseudo_label_feature(feature_network, predict_network, target_list_no_label,
+                                                      prep_dict, batch_size, use_gpu)
+    tar_group = seperate_data.group_by_class(tar_label, class_num)
+
+    # the per-class forwards below run in eval mode as well, like every extraction of feature_extractor
+    with feature_extractor.eval_mode([feature_network, predict_network]):
+        # validation features and scores from one forward
+        forward = feature_extractor.forward_pair(feature_network, predict_network)
+        # load different class's image
+        for cls in range(class_num):
+            dsets_src = ImageList(src_cls_list[cls], transform=prep_dict)
+            dset_loaders_src = util_data.DataLoader(dsets_src, batch_size=batch_size, shuffle=True, num_workers=4)
+
+            dsets_val = ImageList(val_cls_list[cls], transform=prep_dict)
+            dset_loaders_val = util_data.DataLoader(dsets_val, batch_size=batch_size, shuffle=True, num_workers=4)
+
+            # prepare source feature
+            iter_src = iter(dset_loaders_src)
             src_input = iter_src.next()[0]
             if use_gpu:
                 src_input = Variable(src_input).cuda()
             else:
                 src_input = Variable(src_input)
-            src_feature_new, _ = feature_network(src_input)
-            src_feature_new_de = src_feature_new.detach().cpu().numpy()
-            src_feature_de = np.append(src_feature_de, src_feature_new_de, axis=0)
-
-        # prepare target feature
-        iter_tar = iter(dset_loaders_tar)
-        tar_input = iter_tar.next()[0]
-        if use_gpu:
-            tar_input = Variable(tar_input).cuda()
-        else:
-            tar_input = Variable(tar_input)
-        tar_feature, _ = feature_network(tar_input)
-        tar_feature_de = tar_feature.detach().cpu().numpy()
-        for count_tar in range(len(dset_loaders_tar) - 1):
-            tar_input = iter_tar.next()[0]
-            if use_gpu:
-                tar_input = Variable(tar_input).cuda()
-            else:
-                tar_input = Variable(tar_input)
-            tar_feature_new, _ = feature_network(tar_input)
-            tar_feature_new_de = tar_feature_new.detach().cpu().numpy()
-            tar_feature_de = np.append(tar_feature_de, tar_feature_new_de, axis=0)
-
-        # prepare validation feature and predicted label for validation
-
-        iter_val = iter(dset_loaders_val)
-        val_input, val_labels = iter_val.next()
-        if use_gpu:
-            val_input, val_labels = Variable(val_input).cuda(), Variable(val_labels).cuda()
-        else:
-            val_input, val_labels = Variable(val_input), Variable(val_labels)
-        val_feature, _ = feature_network(val_input)
-        _, pred_label = predict_network(val_input)
-        val_feature_de = val_feature.detach().cpu().numpy()
-
-        w = pred_label[0].shape[0]
-        error = np.zeros(1)
-
-        error[0] = predict_loss(cls, pred_label[0].reshape(1, w)).item()
-        error = error.reshape(1, 1)
-        for num_image in range(1, len(pred_label)):
-            single_pred_label = pred_label[num_image]
-            w = single_pred_label.shape[0]
-            error = np.append(error, [[predict_loss(cls, single_pred_label.reshape(1, w)).item()]], axis=0)
-        for count_val in range(len(dset_loaders_val) - 1):
+            src_feature, _ = feature_network(src_input)
+            src_feature_de = src_feature.detach().cpu().numpy()
+            for count_src in range(len(dset_loaders_src) - 1):
+                src_input = iter_src.next()[0]
+                if use_gpu:
+                    src_input = Variable(src_input).cuda()
+                else:
+                    src_input = Variable(src_input)
+                src_feature_new, _ = feature_network(src_input)
+                src_feature_new_de = src_feature_new.detach().cpu().numpy()
+                src_feature_de = np.append(src_feature_de, src_feature_new_de, axis=0)
+
+            # target feature of this pesudolabel
+            tar_feature_de = tar_feature_all[tar_group[cls]]
+
+            # prepare validation feature and predicted label for validation
+
+            iter_val = iter(dset_loaders_val)
             val_input, val_labels = iter_val.next()
             if use_gpu:
                 val_input, val_labels = Variable(val_input).cuda(), Variable(val_labels).cuda()
             else:
                 val_input, val_labels = Variable(val_input), Variable(val_labels)
-            val_feature_new, _ = feature_network(val_input)
-
-            val_feature_new_de = val_feature_new.detach().cpu().numpy()
-            val_feature_de = np.append(val_feature_de, val_feature_new_de, axis=0)
-            _, pred_label = predict_network(val_input)
-            for num_image in range(len(pred_label)):
-                single_pred_label = pred_label[num_image]
-                w = single_pred_label.shape[0]
-            # cls should be a value, new_labels should be a [[x]] tensor format, the input format required by predict_loss
-                error = np.append(error, [[predict_loss(cls, single_pred_label.reshape(1, w)).item()]], axis=0)
+            val_feature, pred_label = forward(val_input)
+            val_feature_de = val_feature.detach().cpu().numpy()
+            error = [dev_error.batch_error(pred_label, cls, error_type).detach().cpu().numpy()]
+            for count_val in range(len(dset_loaders_val) - 1):
+                val_input, val_labels = iter_val.next()
+                if use_gpu:
+                    val_input, val_labels = Variable(val_input).cuda(), Variable(val_labels).cuda()
+                else:
+                    val_input, val_labels = Variable(val_input), Variable(val_labels)
+                val_feature_new, pred_label = forward(val_input)
+
+                val_feature_new_de = val_feature_new.detach().cpu().numpy()
+                val_feature_de = np.append(val_feature_de, val_feature_new_de, axis=0)
+                error.append(dev_error.batch_error(pred_label, cls, error_type).detach().cpu().numpy())
             # error should be a (N, 1) numpy array, the input format required by get_dev_risk
+            error = np.concatenate(error)
 
-        # print(cls)
-        weight = get_weight(src_feature_de, tar_feature_de, val_feature_de)
-        cross_val_loss = cross_val_loss + get_dev_risk(weight, error)/class_num
-
+            # print(cls)
+            weight = get_weight(src_feature_de, tar_feature_de, val_feature_de, n_jobs, seed, estimator)
+            cross_val_loss = cross_val_loss + get_dev_risk(weight, error)/class_num
 
     return cross_val_loss
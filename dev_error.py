@@ -0,0 +1,55 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def cross_entropy_error(score, label):
+    """
+    Cross entropy of every sample, computed in double like the old per-image predict_loss
+    :param score: shape [N, C], prediction scores (logits)
+    :param label: shape [N], ground truth class
+    :return: shape [N]
+    """
+    return F.cross_entropy(score.double(), label, reduction='none')
+
+
+def zero_one_error(score, label):
+    """
+    0 for correct classification and 1 for wrong classification
+    :param score: shape [N, C], prediction scores (logits)
+    :param label: shape [N], ground truth class
+    :return: shape [N]
+    """
+    _, predict_label = torch.max(score, 1)
+    return (predict_label != label).double()
+
+
+def brier_error(score, label):
+    """
+    Squared distance between the softmax output and the one-hot ground truth
+    :param score: shape [N, C], prediction scores (logits)
+    :param label: shape [N], ground truth class
+    :return: shape [N]
+    """
+    prob = F.softmax(score.double(), dim=1)
+    one_hot = torch.zeros_like(prob).scatter_(1, label.view(-1, 1), 1.0)
+    return torch.sum((prob - one_hot) ** 2, dim=1)
+
+
+error_dict = {"cross_entropy": cross_entropy_error, "zero_one": zero_one_error, "brier": brier_error}
+
+
+def batch_error(score, label, error_type="cross_entropy"):
+    """
+    Calculate the error of a whole batch of predictions at once, on whatever device score lives on
+    :param score: shape [N, C], prediction scores (logits)
+    :param label: shape [N] tensor / numpy array of ground truth classes, or a single int shared by the batch
+    :param error_type: one of the keys of error_dict
+    :return: shape [N, 1], the input format required by get_dev_risk
+    """
+    if not torch.is_tensor(label):
+        label = torch.from_numpy(np.asarray(label))
+    label = label.to(score.device).long()
+    if label.dim() == 0:
+        label = label.expand(score.size(0))
+    return error_dict[error_type](score, label).view(-1, 1)
@@ -2,14 +2,18 @@ import random
 import torch
 import math
 import numpy as np
-from sklearn.neural_network import MLPClassifier
 from sklearn.model_selection import train_test_split
+from joblib import Parallel, delayed
+from domain_classifier import fit_domain_classifier
 import torch.utils.data as util_data
 from data_list import ImageList
 import pre_process as prep
 import torch.nn as nn
 from torch.autograd import Variable
 import seperate_data
+import dev_error
+import feature_extractor
+import density_ratio
 
 def get_dev_risk(weight, error):
     """
@@ -29,36 +33,40 @@ def get_dev_risk(weight, error):
     print(eta)
     return np.mean(weighted_error) + eta * np.mean(weight) - eta
 
-def get_weight(source_feature, target_feature, validation_feature): # 这三个feature根据类别不同，是不一样的. source与target这里需注意一下数据量threshold 2倍的事儿
+def get_weight(source_feature, target_feature, validation_feature, n_jobs=1, random_state=None, estimator="mlp"): # 这三个feature根据类别不同，是不一样的. source与target这里需注意一下数据量threshold 2倍的事儿
     """
     :param source_feature: shape [N_tr, d], features from training set
     :param target_feature: shape [N_te, d], features from test set
     :param validation_feature: shape [N_v, d], features from validation set
+    :param n_jobs: number of worker processes fitting the weight decay sweep, 1 fits them one after another
+    :param random_state: seed for the train/test split and the classifiers
+    :param estimator: "mlp" for the MLP domain classifier, or a key of density_ratio.estimator_dict
     :return:
     """
+    if estimator != "mlp":
+        return density_ratio.estimator_dict[estimator](source_feature, target_feature, validation_feature)
     N_s, d = source_feature.shape  
     N_t, _d = target_feature.shape
 
     target_feature = target_feature.copy()
     all_feature = np.concatenate((source_feature, target_feature))
     all_label = np.asarray([1] * N_s + [0] * N_t,dtype=np.int32) # 1->source 0->target
-    feature_for_train,feature_for_test, label_for_train,label_for_test = train_test_split(all_feature, all_label, train_size = 0.8)
+    feature_for_train,feature_for_test, label_for_train,label_for_test = train_test_split(all_feature, all_label, train_size = 0.8, random_state=random_state)
 
     # here is train, test split, concatenating the data from source and target
 
     decays = [1e-1, 3e-2, 1e-2, 3e-3, 1e-3, 3e-4, 1e-4, 3e-5, 1e-5]
-    val_acc = []
-    domain_classifiers = []
-    
-    for decay in decays:
-        domain_classifier = MLPClassifier(hidden_layer_sizes=(d, d, 2),activation='relu',alpha=decay, max_iter=10000)
-        domain_classifier.fit(feature_for_train, label_for_train)
-        output = domain_classifier.predict(feature_for_test)
-        acc = np.mean((label_for_test == output).astype(np.float32))
-        val_acc.append(acc)
-        domain_classifiers.append(domain_classifier)
-        # print('decay is %s, val acc is %s'%(decay, acc))
-        
+
+    if n_jobs == 1:
+        results = [fit_domain_classifier(decay, feature_for_train, label_for_train, feature_for_test, label_for_test,
+                                         random_state) for decay in decays]
+    else:
+        results = Parallel(n_jobs=n_jobs)(delayed(fit_domain_classifier)(decay, feature_for_train, label_for_train,
+                                                                         feature_for_test, label_for_test,
+                                                                         random_state) for decay in decays)
+    domain_classifiers = [result[0] for result in results]
+    val_acc = [result[1] for result in results]
+
     index = val_acc.index(max(val_acc))
     
     print('val acc is')
@@ -76,51 +84,53 @@ def predict_loss(cls, y_pre): #requires how the loss is calculated for the predu
     :param y_pre:
     :return:
     """
-    cls_torch = np.full(1, cls)
-    pre_cls_torch = y_pre.double()
-    target = torch.from_numpy(cls_torch).cuda()
-    entropy = nn.CrossEntropyLoss()
-    return entropy(pre_cls_torch, target)
+    return dev_error.batch_error(y_pre, cls).mean()
 
 
 def get_label_list(target_list, predict_network_name, resize_size, crop_size, batch_size, use_gpu):
     # done with debugging, works fine
     """
-    Return the target list with pesudolabel
+    Pesudolabel the target list
     :param target_list: list conatinging all target file path and a wrong label
     :param predict_network: network to perdict label for target image
     :param resize_size:
     :param crop_size:
     :param batch_size:
-    :return:
+    :return: image paths [N] and their pesudolabels, an int32 numpy array [N], in list order
     """
-    label_list = []
     net_config = predict_network_name
     predict_network = net_config["name"](**net_config["params"])
     if use_gpu:
         predict_network = predict_network.cuda()
 
 
-    dsets_tar = ImageList(target_list, transform=prep.image_train(resize_size=resize_size, crop_size=crop_size))
-    dset_loaders_tar = util_data.DataLoader(dsets_tar, batch_size=batch_size, shuffle=True, num_workers=4)
-    len_train_target = len(dset_loaders_tar)
-    iter_target = iter(dset_loaders_tar)
-    count = 0
-    for i in range(len_train_target):
-        input_tar, label_tar = iter_target.next()
-        if use_gpu:
-            input_tar, label_tar = Variable(input_tar).cuda(), Variable(label_tar).cuda()
-        else:
-            input_tar, label_tar = Variable(input_tar), Variable(label_tar)
-        _, predict_score = predict_network(input_tar)
-        _, predict_label = torch.max(predict_score, 1)
-        for num in range(len(predict_label.cpu())):
-            label_list.append(target_list[count][:-2])
-            label_list[count] = label_list[count] + str(predict_label[num].cpu().numpy()) + "\n"
-            count += 1
-    return label_list
-
-def cross_validation_loss(feature_network, predict_network, src_list, target_path, val_list, class_num, resize_size, crop_size, batch_size, use_gpu):
+    prep_dict = prep.image_train(resize_size=resize_size, crop_size=crop_size)
+    # one device to host copy per batch, labels stay an array
+    forward = feature_extractor.forward_pair(predict_network, predict_network)
+    label_list = [score.argmax(axis=1) for _, score, _ in
+                  feature_extractor.iterate_feature(forward, target_list, prep_dict, batch_size, use_gpu,
+                                                    [predict_network])]
+    return seperate_data.list_path(target_list), np.concatenate(label_list).astype(np.int32)
+
+def extract_feature(feature_network, predict_network, image_list, prep_dict, batch_size, use_gpu,
+                    feature_store=None, transform_config=None):
+    """
+    Run an image list through the networks exactly once, features and scores come from the same forward
+    :param feature_network: network whose first output is the feature
+    :param predict_network: network whose second output is the prediction score
+    :param image_list: list of "path label" lines
+    :param prep_dict: transform applied to every image
+    :param batch_size:
+    :param use_gpu:
+    :param feature_store: optional feature_store.FeatureStore, the backbone is skipped on a hit
+    :param transform_config: json serializable description of prep_dict, part of the store key
+    :return: features [N, d], prediction scores [N, C] and labels [N] as numpy arrays, in list order
+    """
+    return feature_extractor.extract_feature(feature_extractor.forward_pair(feature_network, predict_network),
+                                             [feature_network, predict_network], image_list, prep_dict, batch_size,
+                                             use_gpu, feature_store, transform_config)
+
+def cross_validation_loss(feature_network, predict_network, src_list, target_path, val_list, class_num, resize_size, crop_size, batch_size, use_gpu, error_type="cross_entropy", feature_store=None, n_jobs=1, seed=None, estimator="mlp", deterministic=False, crop_cache=None):
     """
     Main function for computing the CV loss
     :param feature_network:
@@ -132,6 +142,13 @@ def cross_validation_loss(feature_network, predict_network, src_list, target_pat
     :param resize_size:
     :param crop_size:
     :param batch_size:
+    :param error_type: key of dev_error.error_dict
+    :param feature_store: optional feature_store.FeatureStore caching the extracted features
+    :param n_jobs: worker processes fitting the domain classifiers of get_weight
+    :param seed: random_state of get_weight
+    :param estimator: "mlp", "logistic", "ulsif" or "lda", see get_weight
+    :param deterministic: extract with the center crop of prep.image_test instead of random training crops
+    :param crop_cache: optional directory caching the preprocessed uint8 crops, implies deterministic
     :return:
     """
     val_list = seperate_data.dimension_rd(val_list)
@@ -139,106 +156,17 @@ def cross_validation_loss(feature_network, predict_network, src_list, target_pat
     tar_list = open(target_path).readlines()
     cross_val_loss = 0
 
-    prep_dict = prep.image_train(resize_size=resize_size, crop_size=crop_size)
-    # load different class's image
-    
-    dsets_src = ImageList(src_list, transform=prep_dict)
-    dset_loaders_src = util_data.DataLoader(dsets_src, batch_size=batch_size, shuffle=True, num_workers=4)
-    dsets_val = ImageList(val_list, transform=prep_dict)
-    dset_loaders_val = util_data.DataLoader(dsets_val, batch_size=batch_size, shuffle=True, num_workers=4)
-    dsets_tar = ImageList(tar_list, transform=prep_dict)
-    dset_loaders_tar = util_data.DataLoader(dsets_tar, batch_size=batch_size, shuffle=True, num_workers=4)
-
-    # prepare source feature
-    iter_src = iter(dset_loaders_src)
-    src_input, src_labels = iter_src.next()
-    if use_gpu:
-        src_input, src_labels = Variable(src_input).cuda(), Variable(src_labels).cuda()
-    else:
-        src_input, src_labels = Variable(src_input), Variable(src_labels)
-    src_feature, _ = feature_network(src_input)
-    src_feature_de = src_feature.detach().cpu().numpy()
-    for _ in range(len(dset_loaders_src) - 1):
-        src_input, src_labels = iter_src.next()
-        if use_gpu:
-            src_input, src_labels = Variable(src_input).cuda(), Variable(src_labels).cuda()
-        else:
-            src_input, src_labels = Variable(src_input), Variable(src_labels)
-        src_feature_new, _ = feature_network(src_input)
-        src_feature_new_de = src_feature_new.detach().cpu().numpy()
-        src_feature_de = np.append(src_feature_de, src_feature_new_de, axis=0)
-        # src_feature = torch.cat((src_feature, src_feature_new), 0)
-
-    # prepare target feature
-    iter_tar = iter(dset_loaders_tar)
-    tar_input, _ = iter_tar.next()
-    if use_gpu:
-        tar_input, _ = Variable(tar_input).cuda(), Variable(_).cuda()
-    else:
-        src_input, _ = Variable(tar_input), Variable(_)
-    tar_feature, _ = feature_network(tar_input)
-    tar_feature_de = tar_feature.detach().cpu().numpy()
-    for _ in range(len(dset_loaders_tar) - 1):
-        tar_input, _ = iter_tar.next()
-        if use_gpu:
-            tar_input, _ = Variable(tar_input).cuda(), Variable(_).cuda()
-        else:
-            src_input, _ = Variable(tar_input), Variable(_)
-        tar_feature_new, _ = feature_network(tar_input)
-        tar_feature_new_de = src_feature_new.detach().cpu().numpy()
-        tar_feature_de = np.append(tar_feature_de, tar_feature_new_de, axis=0)
-        # tar_feature = torch.cat((tar_feature, tar_feature_new), 0)
-
-    # prepare validation feature and predicted label for validation
-    iter_val = iter(dset_loaders_val)
-    val_input, val_labels = iter_val.next()
-    if use_gpu:
-        val_input, val_labels = Variable(val_input).cuda(), Variable(val_labels).cuda()
-    else:
-        val_input, val_labels = Variable(val_input), Variable(val_labels)
-    val_feature, _ = feature_network(val_input)
-    _, pred_label = predict_network(val_input)
-    val_feature_de = val_feature.detach().cpu().numpy()
-
-    w = pred_label[0].shape[0]
-    error = np.zeros(1)
-
-    error[0] = predict_loss(val_labels[0].item(), pred_label[0].reshape(1, w)).item()
-    error = error.reshape(1,1)
-    print("Before the final")
-    print(pred_label.shape)
-    print(len(val_feature_de))
-    for num_image in range(1, len(pred_label)):
-        single_pred_label = pred_label[num_image]
-        w = single_pred_label.shape[0]
-        single_val_label = val_labels[num_image]
-        error = np.append(error, [[predict_loss(single_val_label.item(), single_pred_label.reshape(1, w)).item()]], axis=0)
-
-    for _ in range(len(dset_loaders_val) - 1):
-        val_input, val_labels = iter_val.next()
-        if use_gpu:
-            val_input, val_labels = Variable(val_input).cuda(), Variable(val_labels).cuda()
-        else:
-            val_input, val_labels = Variable(val_input), Variable(val_labels)
-        val_feature_new, _ = feature_network(val_input)
-
-        val_feature_new_de = val_feature_new.detach().cpu().numpy()
-        val_feature_de = np.append(val_feature_de, val_feature_new_de, axis=0)
-        # val_feature = torch.cat((val_feature, val_feature_new), 0)
-        _, pred_label = predict_network(val_input)
-        for num_image in range(len(pred_label)):
-            single_pred_label = pred_label[num_image]
-            w = single_pred_label.shape[0]
-            single_val_label = val_labels[num_image]
-            error = np.append(error, [[predict_loss(single_val_label.item(), single_pred_label.reshape(1, w)).item()]], axis=0)
-    #     print("Insides the for loop")
-    #     print(len(error))
-    #     print(len(val_feature_de))
-    #
-    # print("Input for scrore calculation: ")
-    # print(len(error))
-    # print(len(val_feature_de))
-    weight = get_weight(src_feature_de, tar_feature_de, val_feature_de)
+    prep_dict, transform_config = feature_extractor.dev_transform(resize_size, crop_size, deterministic, crop_cache)
+
+    # prepare source, target and validation feature, and predicted label for validation
+    src_feature_de, _, _ = extract_feature(feature_network, predict_network, src_list, prep_dict, batch_size,
+                                           use_gpu, feature_store, transform_config)
+    tar_feature_de, _, _ = extract_feature(feature_network, predict_network, tar_list, prep_dict, batch_size,
+                                           use_gpu, feature_store, transform_config)
+    val_feature_de, val_score, val_labels = extract_feature(feature_network, predict_network, val_list, prep_dict,
+                                                            batch_size, use_gpu, feature_store, transform_config)
+    error = dev_error.batch_error(torch.from_numpy(np.array(val_score)), val_labels, error_type).numpy()
+    weight = get_weight(src_feature_de, tar_feature_de, val_feature_de, n_jobs, seed, estimator)
     cross_val_loss = cross_val_loss + get_dev_risk(weight, error)
 
     return cross_val_loss
@@ -16,8 +16,12 @@ import pre_process as prep
 import torch.nn as nn
 from torch.autograd import Variable
 import seperate_data
+import dev_error
+import feature_extractor
+import density_ratio
 from basenet import *
 import mlp_network
+import domain_classifier
 
 def get_dev_risk(weight, error):
     """
@@ -37,14 +41,27 @@ def get_dev_risk(weight, error):
     print(eta)
     return np.mean(weighted_error) + eta * np.mean(weight) - eta
 
-def get_weight(source_feature_path, target_feature_path, validation_feature_path): # 这三个feature根据类别不同，是不一样的. source与target这里需注意一下数据量threshold 2倍的事儿
+def get_weight(source_feature_path, target_feature_path, validation_feature_path, batch_size=None, epochs=10, estimator="mlp"): # 这三个feature根据类别不同，是不一样的. source与target这里需注意一下数据量threshold 2倍的事儿
     """
     :param source_feature: shape [N_tr, d], features from training set
     :param target_feature: shape [N_te, d], features from test set
     :param validation_feature: shape [N_v, d], features from validation set
+    :param batch_size: when set, the files are memory-mapped and the domain classifiers are trained on shuffled
+    mini-batches of this size for epochs passes, so memory stays proportional to the batch
+    :param epochs: epoch budget of the mini-batch trainer
+    :param estimator: "mlp" for the MLP domain classifiers, or a key of density_ratio.estimator_dict
     :return:
     """
     print("Start calculating weight")
+    if estimator != "mlp":
+        return density_ratio.estimator_dict[estimator](np.load(source_feature_path, mmap_mode="r"),
+                                                       np.load(target_feature_path, mmap_mode="r"),
+                                                       np.load(validation_feature_path, mmap_mode="r"))
+    decays = [1e-1, 3e-2, 1e-2, 3e-3, 1e-3, 3e-4, 1e-4, 3e-5, 1e-5, 0.0005]
+    if batch_size is not None:
+        return domain_classifier.get_weight_streaming(source_feature_path, target_feature_path,
+                                                      validation_feature_path, decays, batch_size=batch_size,
+                                                      epochs=epochs, max_ratio=None)
 
     print("Loading feature files")
     source_feature = np.load(source_feature_path)
@@ -71,91 +88,19 @@ def get_weight(source_feature_path, target_feature_path, validation_feature_path
 
     # here is train, test split, concatenating the data from source and target
 
-    decays = [1e-1, 3e-2, 1e-2, 3e-3, 1e-3, 3e-4, 1e-4, 3e-5, 1e-5, 0.0005]
-    val_acc = []
-    domain_classifiers = []
-
-    # created the MLP network
-    MLP = mlp_network.MLP(d, 2).cuda()
-    loss_function = nn.CrossEntropyLoss()
-
-    # convert all numpy to variables
-    feature_train_list = np.array_split(feature_for_train_np, 13, axis=0)
-    feature_test_list = np.array_split(feature_for_test_np, 13, axis=0)
-    label_train_list = np.array_split(label_for_train_np, 13, axis=0)
-    label_test_list = np.array_split(label_for_test_np, 13, axis=0)
-
-    validation_feature = Variable(torch.from_numpy(validation_feature_np)).cuda()
+    # all decays are trained at once on 13 chunks of the training set, the best one is kept in memory
     print("start training")
-    for decay in decays:
-        print("Decay: {}".format(decay))
-        part_count = 0
-        for ep in range(1, 2001):
-            if part_count == 13:
-                part_count = 0
-            feature_for_train = Variable(torch.from_numpy(feature_train_list[part_count])).cuda()
-            label_for_train = Variable(torch.from_numpy(label_train_list[part_count]).long()).cuda()
-
-            optimizer = torch.optim.Adam(MLP.parameters(), lr=0.001, weight_decay=decay)
-            pred = MLP(feature_for_train)
-            loss = loss_function(pred, label_for_train)
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-
-            part_count = part_count + 1
-            # check training accuracy
-            if ep % 100 == 0:
-                print("Check for testing set accuracy")
-                correct = 0
-                for i in range(13):
-                    feature_for_test = Variable(torch.from_numpy(feature_test_list[i])).cuda()
-                    label_for_test = Variable(torch.from_numpy(label_test_list[i]).long()).cuda()
-                    pred_test = MLP(feature_for_test)
-                    predicted_test = torch.max(F.softmax(pred_test), dim=1)[1]
-                    pred_y = predicted_test.detach().cpu().numpy().squeeze()
-                    label_y = label_for_test.detach().cpu().numpy()
-                    correct += sum(pred_y == label_y)
-                accuracy = correct / label_for_test_np.size
-                print("Accuracy is {}".format(accuracy))
-        if not os.path.exists(source_feature_path.split("/")[0] + "/MLP_weight/"):
-            os.makedirs(source_feature_path.split("/")[0] + "/MLP_weight/")
-        pre_path = source_feature_path.split("/")[0] + "/MLP_weight/"+"MLP" + str(accuracy)
-        path = pre_path.replace(".", "_") + ".pth"
-        torch.save(MLP, path)
-        domain_classifiers.append(path)
-        val_acc.append(accuracy)
-
-    index = val_acc.index(max(val_acc))
-    path_2_load = domain_classifiers[index]
-
-    Best_MLP = torch.load(path_2_load)
-
-    out = Best_MLP(validation_feature)
-    domain_out = out.detach().cpu().numpy()
+    Best_MLP, val_acc = domain_classifier.train_domain_classifiers(feature_for_train_np, label_for_train_np,
+                                                                   feature_for_test_np, label_for_test_np, decays,
+                                                                   epochs=2000, num_parts=13)
+    device = next(Best_MLP.parameters()).device
+    validation_feature = torch.from_numpy(np.asarray(validation_feature_np, dtype=np.float32)).to(device)
+    with torch.no_grad():
+        out = F.softmax(Best_MLP(validation_feature), dim=1)
+    domain_out = out.cpu().numpy()
     print("Domain out: {}".format(domain_out))
     return domain_out[:, :1] / domain_out[:, 1:] * N_s * 1.0 / N_t  # (Ntr/Nts)*(1-M(fv))/M(fv)
 
-def random_select_src(source_feature, target_feature):
-    # done with debugging
-    """
-    Select at most 2*Ntr data from source feature randomly
-    :param source_feature: shape [N_tr, d], features from training set
-    :param target_feature: shape [N_te, d], features from test set
-    :return:
-    """
-    N_s, d = source_feature.shape
-    N_t, _d = target_feature.shape
-    items = [i for i in range(1, N_s)]
-    random_list = random.sample(items, 2 * N_t - 1)
-    new_source_feature = source_feature[0].reshape(1, d)
-    for i in range(2 * N_t - 1):
-        new_source_feature = np.concatenate((new_source_feature, source_feature[random_list[i]].reshape(1, d)))
-
-    print("random_select:")
-    print(new_source_feature.shape)
-    return new_source_feature
-
 def predict_loss(cls, y_pre): #requires how the loss is calculated for the preduct value and the ground truth value
     """
     Calculate the cross entropy loss for prediction of one picture
@@ -163,53 +108,52 @@ def predict_loss(cls, y_pre): #requires how the loss is calculated for the predu
     :param y_pre:
     :return:
     """
-    cls_torch = np.full(1, cls)
-    pre_cls_torch = y_pre.double()
-    target = torch.from_numpy(cls_torch).cuda()
-    # target = cls
-    entropy = nn.CrossEntropyLoss()
-    print(cls)
-    return entropy(pre_cls_torch, target).detach().cpu()
+    return dev_error.batch_error(y_pre, cls).mean().detach().cpu()
 
 def get_label_list(target_list, predict_network_name, resize_size, crop_size, batch_size, use_gpu):
     # done with debugging, works fine
     """
-    Return the target list with pesudolabel
+    Pesudolabel the target list
     :param target_list: list conatinging all target file path and a wrong label
     :param predict_network: network to perdict label for target image
     :param resize_size:
     :param crop_size:
     :param batch_size:
-    :return:
+    :return: image paths [N] and their pesudolabels, an int32 numpy array [N], in list order
     """
-    label_list = []
     net_config = predict_network_name
     predict_network = net_config["name"](**net_config["params"])
     if use_gpu:
         predict_network = predict_network.cuda()
 
 
-    dsets_tar = ImageList(target_list, transform=prep.image_train(resize_size=resize_size, crop_size=crop_size))
-    dset_loaders_tar = util_data.DataLoader(dsets_tar, batch_size=batch_size, shuffle=True, num_workers=4)
-    len_train_target = len(dset_loaders_tar)
-    iter_target = iter(dset_loaders_tar)
-    count = 0
-    for i in range(len_train_target):
-        input_tar, label_tar = iter_target.next()
-        if use_gpu:
-            input_tar, label_tar = Variable(input_tar).cuda(), Variable(label_tar).cuda()
-        else:
-            input_tar, label_tar = Variable(input_tar), Variable(label_tar)
-        _, predict_score = predict_network(input_tar)
-        _, predict_label = torch.max(predict_score, 1)
-        for num in range(len(predict_label.cpu())):
-            label_list.append(target_list[count][:-2])
-            label_list[count] = label_list[count] + str(predict_label[num].cpu().numpy()) + "\n"
-            count += 1
-    return label_list
+    prep_dict = prep.image_train(resize_size=resize_size, crop_size=crop_size)
+    # one device to host copy per batch, labels stay an array
+    forward = feature_extractor.forward_pair(predict_network, predict_network)
+    label_list = [score.argmax(axis=1) for _, score, _ in
+                  feature_extractor.iterate_feature(forward, target_list, prep_dict, batch_size, use_gpu,
+                                                    [predict_network])]
+    return seperate_data.list_path(target_list), np.concatenate(label_list).astype(np.int32)
+
+def extract_feature(G, F1, image_list, prep_dict, batch_size, use_gpu, feature_store=None, transform_config=None):
+    """
+    Run an image list through G and F1 once, in batches, F1 is fed with the output of G
+    :param G: feature network
+    :param F1: classifier fed with the output of G
+    :param image_list: list of "path label" lines
+    :param prep_dict: transform applied to every image
+    :param batch_size:
+    :param use_gpu:
+    :param feature_store: optional feature_store.FeatureStore, the backbone is skipped on a hit
+    :param transform_config: json serializable description of prep_dict, part of the store key
+    :return: features [N, d], prediction scores [N, C] and labels [N] as numpy arrays, in list order
+    """
+    return feature_extractor.extract_feature(feature_extractor.forward_stacked(G, F1), [G, F1], image_list,
+                                             prep_dict, batch_size, use_gpu, feature_store, transform_config)
 
 def cross_validation_loss(args, feature_network_path, predict_network_path, num_layer, src_list, target_path, val_list, class_num,
-                          resize_size, crop_size, batch_size, use_gpu):
+                          resize_size, crop_size, batch_size, use_gpu, error_type="cross_entropy", feature_store=None,
+                          mlp_batch_size=None, mlp_epochs=10, estimator="mlp", deterministic=False, crop_cache=None):
     """
     Main function for computing the CV loss
     :param feature_network:
@@ -221,6 +165,13 @@ def cross_validation_loss(args, feature_network_path, predict_network_path, num_
     :param resize_size:
     :param crop_size:
     :param batch_size:
+    :param error_type: key of dev_error.error_dict
+    :param feature_store: optional feature_store.FeatureStore caching the extracted features
+    :param mlp_batch_size: mini-batch size of the streaming domain classifier trainer, None trains in memory
+    :param mlp_epochs: epoch budget of the streaming trainer
+    :param estimator: "mlp", "logistic", "ulsif" or "lda", see get_weight
+    :param deterministic: extract with the center crop of prep.image_test instead of random training crops
+    :param crop_cache: optional directory caching the preprocessed uint8 crops, implies deterministic
     :return:
     """
     option = 'resnet' + args.resnet
@@ -240,118 +191,32 @@ def cross_validation_loss(args, feature_network_path, predict_network_path, num_
     tar_list = open(target_path).readlines()
     cross_val_loss = 0
 
-    prep_dict = prep.image_train(resize_size=resize_size, crop_size=crop_size)
-    # load different class's image
-
-    dsets_src = ImageList(src_list, transform=prep_dict)
-    dset_loaders_src = util_data.DataLoader(dsets_src, batch_size=batch_size, shuffle=True, num_workers=4)
-
-    # prepare source feature
+    prep_dict, transform_config = feature_extractor.dev_transform(resize_size, crop_size, deterministic, crop_cache)
 
-    iter_src = iter(dset_loaders_src)
-    src_input, src_labels = iter_src.next()
-    if use_gpu:
-        src_input, src_labels = Variable(src_input).cuda(), Variable(src_labels).cuda()
-    else:
-        src_input, src_labels = Variable(src_input), Variable(src_labels)
-    feature_val = G(src_input)
-    src_feature_de = feature_val.detach().detach().cpu().numpy()
-
-    for _ in range(len(dset_loaders_src) - 1):
-        src_input, src_labels = iter_src.next()
-        if use_gpu:
-            src_input, src_labels = Variable(src_input).cuda(), Variable(src_labels).cuda()
-        else:
-            src_input, src_labels = Variable(src_input), Variable(src_labels)
-        src_feature_new = G(src_input)
-        src_feature_new_de = src_feature_new.detach().cpu().numpy()
-        src_feature_de = np.append(src_feature_de, src_feature_new_de, axis=0)
+    # prepare source, target and validation feature, and errors for validation
+    src_feature_de, _, _ = extract_feature(G, F1, src_list, prep_dict, batch_size, use_gpu,
+                                           feature_store, transform_config)
     print("Created Source feature: {}".format(src_feature_de.shape))
-
-    # prepare target feature
-
-    dsets_tar = ImageList(tar_list, transform=prep_dict)
-    dset_loaders_tar = util_data.DataLoader(dsets_tar, batch_size=batch_size, shuffle=True, num_workers=4)
-    iter_tar = iter(dset_loaders_tar)
-    tar_input, _ = iter_tar.next()
-    if use_gpu:
-        tar_input, _ = Variable(tar_input).cuda(), Variable(_).cuda()
-    else:
-        src_input, _ = Variable(tar_input), Variable(_)
-    tar_feature = G(tar_input)
-    tar_feature_de = tar_feature.detach().cpu().numpy()
-    for _ in range(len(dset_loaders_tar) - 1):
-        tar_input, _ = iter_tar.next()
-        if use_gpu:
-            tar_input, _ = Variable(tar_input).cuda(), Variable(_).cuda()
-        else:
-            src_input, _ = Variable(tar_input), Variable(_)
-        tar_feature_new = G(tar_input)
-        tar_feature_new_de = tar_feature_new.detach().cpu().numpy()
-        tar_feature_de = np.append(tar_feature_de, tar_feature_new_de, axis=0)
+    tar_feature_de, _, _ = extract_feature(G, F1, tar_list, prep_dict, batch_size, use_gpu,
+                                           feature_store, transform_config)
     print("Created Target feature: {}".format(tar_feature_de.shape))
-
-    # prepare validation feature
-
-    dsets_val = ImageList(val_list, transform=prep_dict)
-    dset_loaders_val = util_data.DataLoader(dsets_val, batch_size=batch_size, shuffle=True, num_workers=4)
-    iter_val = iter(dset_loaders_val)
-    val_input, val_labels = iter_val.next()
-    if use_gpu:
-        val_input, val_labels = Variable(val_input).cuda(), Variable(val_labels).cuda()
-    else:
-        val_input, val_labels = Variable(val_input), Variable(val_labels)
-    val_feature = G(val_input)
-    pred_label = F1(val_feature)
-    val_feature_de = val_feature.detach().cpu().numpy()
-    w = pred_label[0].shape[0]
-    error = np.zeros(1)
-    error[0] = predict_loss(val_labels[0].item(), pred_label[0].reshape(1, w)).item()
-    error = error.reshape(1,1)
-    print("Before the final")
-    print(pred_label.shape)
-
-    for num_image in range(1, len(pred_label)):
-        new_error = np.zeros(1)
-        single_pred_label = pred_label[num_image]
-        w = single_pred_label.shape[0]
-        single_val_label = val_labels[num_image]
-        new_error[0] = predict_loss(single_val_label.item(), single_pred_label.reshape(1, w)).item()
-        new_error = new_error.reshape(1,1)
-        error = np.append(error, new_error, axis=0)
-    for _ in range(len(dset_loaders_val) - 1):
-        val_input, val_labels = iter_val.next()
-        if use_gpu:
-            val_input, val_labels = Variable(val_input).cuda(), Variable(val_labels).cuda()
-        else:
-            val_input, val_labels = Variable(val_input), Variable(val_labels)
-        val_feature_new = G(val_input)
-        val_feature_new_de = val_feature_new.detach().cpu().numpy()
-        val_feature_de = np.append(val_feature_de, val_feature_new_de, axis=0)
-        pred_label = F1(val_feature_new)
-        for num_image in range(len(pred_label)):
-            new_error = np.zeros(1)
-            single_pred_label = pred_label[num_image]
-            w = single_pred_label.shape[0]
-            single_val_label = val_labels[num_image]
-            new_error[0] = predict_loss(single_val_label.item(), single_pred_label.reshape(1, w)).item()
-            new_error = new_error.reshape(1, 1)
-            error = np.append(error, new_error, axis=0)
-
+    val_feature_de, val_score, val_labels = extract_feature(G, F1, val_list, prep_dict, batch_size, use_gpu,
+                                                            feature_store, transform_config)
+    error = dev_error.batch_error(torch.from_numpy(np.array(val_score)), val_labels, error_type).numpy()
     print("Created Validation error shape: {}".format(error.shape))
     print("Created Validation feature: {}".format(val_feature_de.shape))
 
-    if not os.path.exists(args.save.split("/")[0] + "/feature_np/"):
-        os.makedirs(args.save.split("/")[0] + "/feature_np/")
-
-    np.save(args.save.split("/")[0] + "/feature_np/" + "src_feature_de.npy", src_feature_de)
-    np.save(args.save.split("/")[0] + "/feature_np/" + "tar_feature_de.npy", tar_feature_de)
-    np.save(args.save.split("/")[0] + "/feature_np/" + "val_feature_de.npy", val_feature_de)
-    src_feature_path = args.save.split("/")[0] + "/feature_np/" + "_" + "src_feature_de.npy"
-    tar_feature_path = args.save.split("/")[0] + "/feature_np/" + "_" + "tar_feature_de.npy"
-    val_feature_path = args.save.split("/")[0] + "/feature_np/" + "_" + "val_feature_de.npy"
-    weight = get_weight(src_feature_path, tar_feature_path, val_feature_path)
+    feature_dir = args.save.split("/")[0] + "/feature_np/"
+    if not os.path.exists(feature_dir):
+        os.makedirs(feature_dir)
+    src_feature_path = feature_dir + "src_feature_de.npy"
+    tar_feature_path = feature_dir + "tar_feature_de.npy"
+    val_feature_path = feature_dir + "val_feature_de.npy"
+    np.save(src_feature_path, src_feature_de)
+    np.save(tar_feature_path, tar_feature_de)
+    np.save(val_feature_path, val_feature_de)
+    weight = get_weight(src_feature_path, tar_feature_path, val_feature_path, mlp_batch_size, mlp_epochs,
+                        estimator)
     cross_val_loss = cross_val_loss + get_dev_risk(weight, error)
 
-
     return cross_val_loss
@@ -19,9 +19,14 @@ import torch.nn as nn
 from torch.autograd import Variable
 import torch.autograd as autograd
 import seperate_data
+from subsample import random_select_src
+import dev_error
+import feature_extractor
+import density_ratio
 from basenet import *
 from mlp_network import MLP
 import mlp_network
+import domain_classifier
 
 def get_dev_risk(weight, error):
     """
@@ -44,17 +49,31 @@ def get_dev_risk(weight, error):
 
 
 def get_weight(source_feature_path, target_feature_path,
-               validation_feature_path):  # 这三个feature根据类别不同，是不一样的. source与target这里需注意一下数据量threshold 2倍的事儿
+               validation_feature_path, batch_size=None, epochs=10, estimator="mlp"):  # 这三个feature根据类别不同，是不一样的. source与target这里需注意一下数据量threshold 2倍的事儿
     """
     :param source_feature: shape [N_tr, d], features from training set
     :param target_feature: shape [N_te, d], features from test set
     :param validation_feature: shape [N_v, d], features from validation set
+    :param batch_size: when set, the files are memory-mapped and the domain classifiers are trained on shuffled
+    mini-batches of this size for epochs passes, so memory stays proportional to the batch
+    :param epochs: epoch budget of the mini-batch trainer
+    :param estimator: "mlp" for the MLP domain classifiers, or a key of density_ratio.estimator_dict
     :return:
     """
     print("Start calculating weight")
+    if estimator != "mlp":
+        return density_ratio.estimator_dict[estimator](np.load(source_feature_path, mmap_mode="r"),
+                                                       np.load(target_feature_path, mmap_mode="r"),
+                                                       np.load(validation_feature_path, mmap_mode="r"))
+    decays = [1e-1, 3e-2, 1e-2, 3e-3, 1e-3, 3e-4, 1e-4, 3e-5, 1e-5, 0.0005]
+    if batch_size is not None:
+        return domain_classifier.get_weight_streaming(source_feature_path, target_feature_path,
+                                                      validation_feature_path, decays, batch_size=batch_size,
+                                                      epochs=epochs, max_ratio=2)
 
     print("Loading feature files")
-    source_feature = np.load(source_feature_path)
+    # memory-mapped, only the rows random_select_src keeps are read when the source is subsampled
+    source_feature = np.load(source_feature_path, mmap_mode="r")
     target_feature = np.load(target_feature_path)
     validation_feature_np = np.load(validation_feature_path)
 
@@ -77,99 +96,55 @@ def get_weight(source_feature_path, target_feature_path,
 
     # here is train, test split, concatenating the data from source and target
 
-    decays = [1e-1, 3e-2, 1e-2, 3e-3, 1e-3, 3e-4, 1e-4, 3e-5, 1e-5, 0.0005]
-    val_acc = []
-    domain_classifiers = []
-
-    # created the MLP network
-    MLP = mlp_network.MLP(d, 2).cuda()
-    loss_function = nn.CrossEntropyLoss()
-
-    # convert all numpy to variables
-    feature_for_train = Variable(torch.from_numpy(feature_for_train_np)).cuda()
-    feature_for_test = Variable(torch.from_numpy(feature_for_test_np)).cuda()
-    label_for_train = Variable(torch.from_numpy(label_for_train_np).long()).cuda()
-    label_for_test = Variable(torch.from_numpy(label_for_test_np).long()).cuda()
-    validation_feature = Variable(torch.from_numpy(validation_feature_np)).cuda()
+    # all decays are trained at once, the best one is kept in memory
     print("start training")
-    for decay in decays:
-        print("Decay: {}".format(decay))
-        for ep in range(1, 1001):
-            optimizer = torch.optim.Adam(MLP.parameters(), lr=0.001, weight_decay=decay)
-            pred = MLP(feature_for_train)
-            loss = loss_function(pred, label_for_train)
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-            # check training accuracy
-            if ep % 100 == 0:
-                print("Check for testing set accuracy")
-                pred_test = MLP(feature_for_test)
-                predicted_test = torch.max(F.softmax(pred_test), dim=1)[1]
-                pred_y = predicted_test.detach().cpu().numpy().squeeze()
-                label_y = label_for_test.detach().cpu().numpy()
-                accuracy = sum(pred_y == label_y) / label_y.size
-                print("Accuracy is {}".format(accuracy))
-        pre_path = "MLP" + str(accuracy)
-        path = pre_path.replace(".", "_") + ".pth"
-        torch.save(MLP, path)
-        domain_classifiers.append(path)
-        val_acc.append(accuracy)
-
-    index = val_acc.index(max(val_acc))
-    path_2_load = domain_classifiers[index]
-
-    Best_MLP = torch.load(path_2_load)
-
-    out = Best_MLP(validation_feature)
-    domain_out = out.detach().cpu().numpy()
+    Best_MLP, val_acc = domain_classifier.train_domain_classifiers(feature_for_train_np, label_for_train_np,
+                                                                   feature_for_test_np, label_for_test_np, decays,
+                                                                   epochs=1000)
+    device = next(Best_MLP.parameters()).device
+    validation_feature = torch.from_numpy(np.asarray(validation_feature_np, dtype=np.float32)).to(device)
+    with torch.no_grad():
+        out = F.softmax(Best_MLP(validation_feature), dim=1)
+    domain_out = out.cpu().numpy()
     print("Domain out: {}".format(domain_out))
     return domain_out[:, :1] / domain_out[:, 1:] * N_s * 1.0 / N_t  # (Ntr/Nts)*(1-M(fv))/M(fv)
 
-def random_select_src(source_feature, target_feature):
-    # done with debugging
-    """
-    Select at most 2*Ntr data from source feature randomly
-    :param source_feature: shape [N_tr, d], features from training set
-    :param target_feature: shape [N_te, d], features from test set
-    :return:
-    """
-    N_s, d = source_feature.shape
-    N_t, _d = target_feature.shape
-    items = [i for i in range(1, N_s)]
-    random_list = random.sample(items, 2 * N_t - 1)
-    new_source_feature = source_feature[0].reshape(1, d)
-    for i in range(2 * N_t - 1):
-        new_source_feature = np.concatenate((new_source_feature, source_feature[random_list[i]].reshape(1, d)))
-
-    print("random_select:")
-    print(new_source_feature.shape)
-    return new_source_feature
-
-
 def predict_loss(cls, y_pre):
     # done with debugging works fine
     """
-    Calculate the cross entropy loss for prediction of one picture
+    Calculate the cross entropy loss for prediction of one picture, use dev_error.batch_error for whole batches
     :param cls:
     :param y_pre:
     :return:
     """
-    cls_torch = np.full(1, cls)
-    pre_cls_torch = y_pre.double()
-    target = torch.from_numpy(cls_torch).cuda()
-    entropy = nn.CrossEntropyLoss()
-    return entropy(pre_cls_torch, target).detach().cpu()
+    return dev_error.batch_error(y_pre, cls).mean().detach().cpu()
+
+def extract_feature(G, F1, image_list, prep_dict, batch_size, use_gpu, feature_store=None, transform_config=None):
+    """
+    Run an image list through G and F1 once, in batches, F1 is fed with the output of G
+    :param G: feature network
+    :param F1: classifier fed with the output of G
+    :param image_list: list of "path label" lines
+    :param prep_dict: transform applied to every image
+    :param batch_size:
+    :param use_gpu:
+    :param feature_store: optional feature_store.FeatureStore, the backbone is skipped on a hit
+    :param transform_config: json serializable description of prep_dict, part of the store key
+    :return: features [N, d], prediction scores [N, C] and labels [N] as numpy arrays, in list order
+    """
+    return feature_extractor.extract_feature(feature_extractor.forward_stacked(G, F1), [G, F1], image_list,
+                                             prep_dict, batch_size, use_gpu, feature_store, transform_config)
+
 
 def get_label_list(args, target_list, feature_network_path, predict_network_path, num_layer, resize_size, crop_size, batch_size, use_gpu):
     """
-    Return the target list with pesudolabel
+    Pesudolabel the target list
     :param target_list: list conatinging all target file path and a wrong label
     :param predict_network: network to perdict label for target image
     :param resize_size:
     :param crop_size:
     :param batch_size:
-    :return:
+    :return: image paths [N] and their pesudolabels, an int32 numpy array [N], in list order
     """
     option = 'resnet' + args.resnet
     G = ResBase(option)
@@ -183,35 +158,18 @@ def get_label_list(args, target_list, feature_network_path, predict_network_path
     G.eval()
     F1.eval()
 
-    label_list = []
-    dsets_tar = ImageList(target_list, transform=prep.image_train(resize_size=resize_size, crop_size=crop_size))
-    dset_loaders_tar = util_data.DataLoader(dsets_tar, batch_size=batch_size, shuffle=False, num_workers=4)
-    len_train_target = len(dset_loaders_tar)
-    iter_target = iter(dset_loaders_tar)
-    count = 0
-    for i in range(len_train_target):
-        input_tar, label_tar = iter_target.next()
-        if use_gpu:
-            input_tar, label_tar = Variable(input_tar).cuda(), Variable(label_tar).cuda()
-        else:
-            input_tar, label_tar = Variable(input_tar), Variable(label_tar)
-        tar_feature = G(input_tar)
-        predict_score = F1(tar_feature)
-        _, pre_lab = torch.max(predict_score, 1)
-        predict_label = pre_lab.detach()
-        for num in range(len(predict_label.cpu())):
-            if target_list[count][-3] == ' ':
-                ind = -2
-            else:
-                ind = -3
-            label_list.append(target_list[count][:ind])
-            label_list[count] = label_list[count] + str(predict_label[num].cpu().numpy()) + "\n"
-            count += 1
-    return label_list
+    prep_dict = prep.image_train(resize_size=resize_size, crop_size=crop_size)
+    # one device to host copy per batch, labels stay an array
+    forward = feature_extractor.forward_stacked(G, F1)
+    label_list = [score.argmax(axis=1) for _, score, _ in
+                  feature_extractor.iterate_feature(forward, target_list, prep_dict, batch_size, use_gpu,
+                                                    [G, F1])]
+    return seperate_data.list_path(target_list), np.concatenate(label_list).astype(np.int32)
 
 
 def cross_validation_loss(args, feature_network_path, predict_network_path, num_layer, src_list, target_path, val_list, class_num,
-                          resize_size, crop_size, batch_size, use_gpu):
+                          resize_size, crop_size, batch_size, use_gpu, error_type="cross_entropy", feature_store=None,
+                          mlp_batch_size=None, mlp_epochs=10, estimator="mlp", deterministic=False, crop_cache=None):
     """
     Main function for computing the CV loss
     :param feature_network:
@@ -223,6 +181,13 @@ def cross_validation_loss(args, feature_network_path, predict_network_path, num_
     :param resize_size:
     :param crop_size:
     :param batch_size:
+    :param error_type: key of dev_error.error_dict
+    :param feature_store: optional feature_store.FeatureStore caching the extracted features
+    :param mlp_batch_size: mini-batch size of the streaming domain classifier trainer, None trains in memory
+    :param mlp_epochs: epoch budget of the streaming trainer
+    :param estimator: "mlp", "logistic", "ulsif" or "lda", see get_weight
+    :param deterministic: extract with the center crop of prep.image_test instead of random training crops
+    :param crop_cache: optional directory caching the preprocessed uint8 crops, implies deterministic
     :return:
     """
     target_list_no_label = open(target_path).readlines()
@@ -240,188 +205,50 @@ def cross_validation_loss(args, feature_network_path, predict_network_path, num_
     G.eval()
     F1.eval()
     print("Loaded network")
-    # add pesudolabel for target data
-    print("Sperating target data")
-    tar_list = []
-    dsets_tar = ImageList(target_list_no_label,
-                          transform=prep.image_train(resize_size=resize_size, crop_size=crop_size))
-    dset_loaders_tar = util_data.DataLoader(dsets_tar, batch_size=batch_size, shuffle=False, num_workers=4)
-    len_train_target = len(dset_loaders_tar)
-    iter_target = iter(dset_loaders_tar)
-    count = 0
-    for i in range(len_train_target):
-        input_tar, label_tar = iter_target.next()
-        if use_gpu:
-            input_tar, label_tar = Variable(input_tar).cuda(), Variable(label_tar).cuda()
-        else:
-            input_tar, label_tar = Variable(input_tar), Variable(label_tar)
-        tar_feature = G(input_tar)
-        predict_score = F1(tar_feature)
-        _, pre_lab = torch.max(predict_score, 1)
-        predict_label = pre_lab.detach()
-        for num in range(len(predict_label.cpu())):
-            if target_list_no_label[count][-3] == ' ':
-                ind = -2
-            else:
-                ind = -3
-            tar_list.append(target_list_no_label[count][:ind])
-            tar_list[count] = tar_list[count] + str(predict_label[num].cpu().numpy()) + "\n"
-            count += 1
     val_list = seperate_data.dimension_rd(val_list)
     print("Seperated")
-    # load the dataloader for whole data
-    prep_dict = prep.image_train(resize_size=resize_size, crop_size=crop_size)
-    dsets_src = ImageList(src_list, transform=prep_dict)
-    dset_loaders_src = util_data.DataLoader(dsets_src, batch_size=batch_size, shuffle=True, num_workers=4)
-    dsets_val = ImageList(val_list, transform=prep_dict)
-    dset_loaders_val = util_data.DataLoader(dsets_val, batch_size=batch_size, shuffle=True, num_workers=4)
-    dsets_tar = ImageList(tar_list, transform=prep_dict)
-    dset_loaders_tar = util_data.DataLoader(dsets_tar, batch_size=batch_size, shuffle=True, num_workers=4)
-
-    # iterate through different classes
+    # forward every set once, G and F1 share the same batch
+    prep_dict, transform_config = feature_extractor.dev_transform(resize_size, crop_size, deterministic, crop_cache)
+    src_feature_de, _, src_label = extract_feature(G, F1, src_list, prep_dict, batch_size, use_gpu,
+                                                   feature_store, transform_config)
+    print("Created Source feature: {}".format(src_feature_de.shape))
+    # add pesudolabel for target data from the scores of the same pass
+    tar_feature_de, tar_score, _ = extract_feature(G, F1, target_list_no_label, prep_dict, batch_size, use_gpu,
+                                                   feature_store, transform_config)
+    tar_label = np.argmax(tar_score, axis=1).astype(np.int32)
+    print("Created Target feature: {}".format(tar_feature_de.shape))
+    val_feature_de, val_score, val_label = extract_feature(G, F1, val_list, prep_dict, batch_size, use_gpu,
+                                                           feature_store, transform_config)
+    print("Created Validation feature: {}".format(val_feature_de.shape))
+    error = dev_error.batch_error(torch.from_numpy(np.array(val_score)), val_label, error_type).numpy()
+    print("Created error shape: {}".format(error.shape))
+
+    # split by class with an index mask and write all per-class feature files in one go
+    feature_dir = args.save.split("/")[0] + "/feature_np/"
+    if not os.path.exists(feature_dir):
+        os.makedirs(feature_dir)
+    feature_paths = []
+    src_group = seperate_data.group_by_class(src_label, class_num)
+    tar_group = seperate_data.group_by_class(tar_label, class_num)
+    val_group = seperate_data.group_by_class(val_label, class_num)
     for cls in range(class_num):
-        # prepare source feature
-        count_src = 0
-        src_feature_de = np.array([])
-        iter_src = iter(dset_loaders_src)
-        while src_feature_de.size == 0:
-            src_input, src_labels = iter_src.next()
-            for i in range(len(src_labels)):
-                if src_labels[i].item() == cls:
-                    a, b, c = src_input[i].shape
-                    if use_gpu:
-                        src_pre_input = Variable(src_input[i]).cuda()
-                    else:
-                        src_pre_input = Variable(src_input[i])
-                    src_input_final = src_pre_input.reshape(1, a, b, c)
-                    if src_feature_de.size == 0:
-                        src_feature = G(src_input_final)
-                        src_feature_de = src_feature.detach().detach().cpu().numpy()
-                    else:
-                        src_feature_new = G(src_input_final)
-                        src_feature_new_de = src_feature_new.detach().cpu().numpy()
-                        src_feature_de = np.append(src_feature_de, src_feature_new_de, axis=0)
-            count_src = count_src + 1
-        for _ in range(len(dset_loaders_src) - count_src):
-            src_input, src_labels = iter_src.next()
-            for i in range(len(src_labels)):
-                if src_labels[i].item() == cls:
-                    a, b, c = src_input[i].shape
-                    if use_gpu:
-                        src_pre_input = Variable(src_input[i]).cuda()
-                    else:
-                        src_pre_input = Variable(src_input[i])
-                    src_input_final = src_pre_input.reshape(1, a, b, c)
-                    src_feature_new = G(src_input_final)
-                    src_feature_new_de = src_feature_new.detach().cpu().numpy()
-                    src_feature_de = np.append(src_feature_de, src_feature_new_de, axis=0)
-        print("Pass Source for Class{}".format(cls + 1))
-        print("Created feature: {}".format(src_feature_de.shape))
-
-        # prepare target fature
-        count_tar = 0
-        tar_feature_de = np.array([])
-        iter_tar = iter(dset_loaders_tar)
-        while tar_feature_de.size == 0:
-            tar_input, tar_labels = iter_tar.next()
-            for i in range(len(tar_labels)):
-                if tar_labels[i].item() == cls:
-                    a, b, c = tar_input[i].shape
-                    if use_gpu:
-                        tar_pre_input = Variable(tar_input[i]).cuda()
-                    else:
-                        tar_pre_input = Variable(tar_input[i])
-                    tar_input_final = tar_pre_input.reshape(1, a, b, c)
-                    tar_feature = G(tar_input_final)
-                    if tar_feature_de.size == 0:
-                        tar_feature_de = tar_feature.detach().cpu().numpy()
-                    else:
-                        tar_feature_new_de = tar_feature.detach().cpu().numpy()
-                        tar_feature_de = np.append(tar_feature_de, tar_feature_new_de, axis=0)
-            count_tar = count_tar + 1
-        for _ in range(len(dset_loaders_tar) - count_tar):
-            tar_input, tar_labels = iter_tar.next()
-            for i in range(len(tar_labels)):
-                if tar_labels[i].item() == cls:
-                    a, b, c = tar_input[i].shape
-                    if use_gpu:
-                        tar_pre_input = Variable(tar_input[i]).cuda()
-                    else:
-                        tar_pre_input = Variable(tar_input[i])
-                    tar_input_final = tar_pre_input.reshape(1, a, b, c)
-                    tar_feature_new = G(tar_input_final)
-                    tar_feature_new_de = tar_feature_new.detach().cpu().numpy()
-                    tar_feature_de = np.append(tar_feature_de, tar_feature_new_de, axis=0)
-        print("Pass Target for Class: {}".format(cls + 1))
-        print("Created feature: {}".format(tar_feature_de.shape))
-        # prepare validation feature and errors
-
-        count_val = 0
-        val_feature_de = np.array([])
-        iter_val = iter(dset_loaders_val)
-        while val_feature_de.size == 0:
-            val_input, val_labels = iter_val.next()
-            for i in range(len(val_labels)):
-                if val_labels[i].item() == cls:
-                    a, b, c = val_input[i].shape
-                    if use_gpu:
-                        val_pre_input, val_labels_final = Variable(val_input[i]).cuda(), Variable(val_labels[i]).cuda()
-                    else:
-                        val_pre_input, val_labels_final = Variable(val_input[i]), Variable(val_labels[i])
-                    val_input_final = val_pre_input.reshape(1, a, b, c)
-                    val_feature = G(val_input_final)
-                    pred_label = F1(val_feature)
-                    w = pred_label.shape[1]
-                    if val_feature_de.size == 0:
-                        # feature and error
-                        val_feature_de = val_feature.detach().cpu().numpy()
-                        error = np.zeros(1)
-                        error[0] = predict_loss(val_labels_final.item(), pred_label.reshape(1, w)).item()
-                        error = error.reshape(1, 1)
-                        print(error)
-                    else:
-                        # feature and error
-                        val_feature_new_de = val_feature.detach().cpu().numpy()
-                        val_feature_de = np.append(val_feature_de, val_feature_new_de, axis=0)
-                        new_error = np.zeros(1)
-                        new_error = new_error.reshape(1, 1)
-                        new_error[0] = predict_loss(val_labels_final.item(), pred_label.reshape(1, w)).item()
-                        error = np.append(error, new_error, axis=0)
-            count_val = count_val + 1
-        for _ in range(len(dset_loaders_val) - count_val):
-            val_input, val_labels = iter_val.next()
-            for i in range(len(val_labels)):
-                if val_labels[i].item() == cls:
-                    a, b, c = val_input[i].shape
-                    if use_gpu:
-                        val_pre_input, val_labels_final = Variable(val_input[i]).cuda(), Variable(val_labels[i]).cuda()
-                    else:
-                        val_pre_input, val_labels_final = Variable(val_input[i]), Variable(val_labels[i])
-                    val_input_final = val_pre_input.reshape(1, a, b, c)
-                    val_feature = G(val_input_final)
-                    pred_label = F1(val_feature)
-                    w = pred_label.shape[1]
-                    val_feature_new_de = val_feature.detach().cpu().numpy()
-                    val_feature_de = np.append(val_feature_de, val_feature_new_de, axis=0)
-                    new_error = np.zeros(1)
-                    new_error = new_error.reshape(1, 1)
-                    new_error[0] = predict_loss(val_labels_final.item(), pred_label.reshape(1, w)).item()
-                    error = np.append(error, new_error, axis=0)
-        print("Pass Validation for Class: {}".format(cls + 1))
-        print("Created error shape: {}".format(error.shape))
-        print("Created feature: {}".format(val_feature_de.shape))
-        # calculating the weight and the score for each class
-
-        if not os.path.exists(args.save.split("/")[0] + "/feature_np/"):
-            os.makedirs(args.save.split("/")[0] + "/feature_np/")
-
-        np.save(args.save.split("/")[0]+ "/feature_np/" + str(cls) + "_" + "src_feature_de.npy", src_feature_de)
-        np.save(args.save.split("/")[0]+ "/feature_np/" + str(cls) + "_" + "tar_feature_de.npy", tar_feature_de)
-        np.save(args.save.split("/")[0]+ "/feature_np/" + str(cls) + "_" + "val_feature_de.npy", val_feature_de)
-        src_feature_path = args.save.split("/")[0]+ "/feature_np/" + str(cls) + "_" + "src_feature_de.npy"
-        tar_feature_path = args.save.split("/")[0]+ "/feature_np/" + str(cls) + "_" + "tar_feature_de.npy"
-        val_feature_path = args.save.split("/")[0]+ "/feature_np/" + str(cls) + "_" + "val_feature_de.npy"
-        weight = get_weight(src_feature_path, tar_feature_path, val_feature_path)
-        cross_val_loss = cross_val_loss + get_dev_risk(weight, error) / class_num
+        src_index, tar_index, val_index = src_group[cls], tar_group[cls], val_group[cls]
+        if len(src_index) == 0 or len(tar_index) == 0 or len(val_index) == 0:
+            print("Class {} has an empty source, target or validation bucket, skipped".format(cls + 1))
+            continue
+        src_feature_path = feature_dir + str(cls) + "_" + "src_feature_de.npy"
+        tar_feature_path = feature_dir + str(cls) + "_" + "tar_feature_de.npy"
+        val_feature_path = feature_dir + str(cls) + "_" + "val_feature_de.npy"
+        np.save(src_feature_path, src_feature_de[src_index])
+        np.save(tar_feature_path, tar_feature_de[tar_index])
+        np.save(val_feature_path, val_feature_de[val_index])
+        feature_paths.append((cls, src_feature_path, tar_feature_path, val_feature_path, val_index))
+
+    # calculating the weight and the score for each class
+    for cls, src_feature_path, tar_feature_path, val_feature_path, val_index in feature_paths:
+        print("Weight for Class: {}".format(cls + 1))
+        weight = get_weight(src_feature_path, tar_feature_path, val_feature_path, mlp_batch_size, mlp_epochs,
+                            estimator)
+        cross_val_loss = cross_val_loss + get_dev_risk(weight, error[val_index]) / class_num
 
     return cross_val_loss
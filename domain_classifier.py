@@ -0,0 +1,267 @@
+import queue
+import threading
+import numpy as np
+import torch
+import torch.nn.functional as F
+from sklearn.neural_network import MLPClassifier
+import mlp_network
+import subsample
+
+
+def batched_accuracy(model, feature_list, label_list, device):
+    """
+    :param model: mlp_network.BatchedMLP
+    :param feature_list: list of [n, d] numpy chunks
+    :param label_list: list of [n] numpy chunks
+    :return: test accuracy of every stacked model, numpy array [n_model]
+    """
+    correct = np.zeros(model.n_model)
+    total = 0
+    with torch.no_grad():
+        for feature, label in zip(feature_list, label_list):
+            pred = model(torch.from_numpy(np.asarray(feature, dtype=np.float32)).to(device))
+            label = torch.from_numpy(np.asarray(label)).long().to(device)
+            correct += (torch.max(pred, 2)[1] == label.view(1, -1)).sum(1).cpu().numpy()
+            total += label.size(0)
+    return correct / total
+
+
+def fit_domain_classifier(decay, feature_for_train, label_for_train, feature_for_test, label_for_test,
+                          random_state=None):
+    """
+    Fit one domain classifier of the weight decay sweep, top level so it can run in a worker process
+    :param decay: L2 penalty of the MLPClassifier
+    :param random_state: seed of the MLPClassifier, fix it to get the same classifier in serial and parallel mode
+    :return: the fitted classifier and its accuracy on the test split
+    """
+    d = feature_for_train.shape[1]
+    classifier = MLPClassifier(hidden_layer_sizes=(d, d, 2), activation='relu', alpha=decay, max_iter=10000,
+                               random_state=random_state)
+    classifier.fit(feature_for_train, label_for_train)
+    output = classifier.predict(feature_for_test)
+    acc = np.mean((label_for_test == output).astype(np.float32))
+    return classifier, acc
+
+
+def add_weight_decay(model, decay):
+    """
+    Add decay * param to every gradient, which is what torch.optim.Adam(weight_decay=decay) does,
+    with a different decay for every stacked model
+    :param decay: tensor [n_model]
+    """
+    for param in model.parameters():
+        if param.grad is not None:
+            param.grad.add_(decay.view(-1, *([1] * (param.dim() - 1))) * param.detach())
+
+
+def train_domain_classifiers(feature_for_train, label_for_train, feature_for_test, label_for_test, decays,
+                             epochs=1000, num_parts=1, lr=0.001, use_gpu=None):
+    """
+    Train one MLP domain classifier per weight decay at the same time, each with its own Adam state
+    :param feature_for_train: shape [N_train, d]
+    :param label_for_train: shape [N_train], 1 for source and 0 for target
+    :param feature_for_test: shape [N_test, d]
+    :param label_for_test: shape [N_test]
+    :param decays: list of weight decays, one model each
+    :param epochs: number of optimizer steps
+    :param num_parts: the training set is cycled through in this many chunks, one chunk per step
+    :param lr:
+    :param use_gpu: defaults to torch.cuda.is_available()
+    :return: the mlp_network.MLP with the best test accuracy, and the test accuracy of every decay
+    """
+    if use_gpu is None:
+        use_gpu = torch.cuda.is_available()
+    device = torch.device("cuda" if use_gpu else "cpu")
+    n_model = len(decays)
+    d = feature_for_train.shape[1]
+
+    model = mlp_network.BatchedMLP(n_model, d, 2).to(device)
+    decay = torch.tensor(decays, dtype=torch.float32, device=device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+
+    feature_train_list = [torch.from_numpy(np.asarray(part, dtype=np.float32))
+                          for part in np.array_split(feature_for_train, num_parts, axis=0)]
+    label_train_list = [torch.from_numpy(np.asarray(part)).long()
+                        for part in np.array_split(label_for_train, num_parts, axis=0)]
+    feature_test_list = np.array_split(feature_for_test, num_parts, axis=0)
+    label_test_list = np.array_split(label_for_test, num_parts, axis=0)
+    if num_parts == 1:
+        # everything fits, keep it on the device
+        feature_train_list = [feature_train_list[0].to(device)]
+        label_train_list = [label_train_list[0].to(device)]
+
+    for ep in range(1, epochs + 1):
+        part_count = (ep - 1) % num_parts
+        feature = feature_train_list[part_count].to(device)
+        label = label_train_list[part_count].to(device)
+        pred = model(feature)
+        # mean cross entropy of every model, summed so each model only gets its own gradient
+        loss = F.cross_entropy(pred.reshape(-1, 2), label.repeat(n_model), reduction='none')
+        loss = loss.view(n_model, -1).mean(1).sum()
+        optimizer.zero_grad()
+        loss.backward()
+        add_weight_decay(model, decay)
+        optimizer.step()
+        if ep % 100 == 0:
+            print("Epoch {}, accuracy is {}".format(ep, batched_accuracy(model, feature_test_list, label_test_list,
+                                                                         device)))
+
+    val_acc = batched_accuracy(model, feature_test_list, label_test_list, device)
+    index = int(np.argmax(val_acc))
+    print("Decay {} is the best, accuracy is {}".format(decays[index], val_acc[index]))
+    return model.extract(index), list(val_acc)
+
+
+def prefetch(generator, size):
+    """
+    Run a generator in a background thread, at most size items ahead of the consumer
+    """
+    buffer = queue.Queue(maxsize=size)
+    end = object()
+
+    def worker():
+        try:
+            for item in generator:
+                buffer.put(item)
+        except Exception as e:
+            buffer.put(e)
+        buffer.put(end)
+
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+    while True:
+        item = buffer.get()
+        if item is end:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+class FeatureStream(object):
+    """Mini-batches of (feature, domain label) read straight from memory-mapped source and target feature files.
+
+    Only row indices are kept in memory, features are gathered batch by batch, so peak memory is proportional
+    to the batch size rather than to the number of samples.
+    Args:
+        source_feature_path (string): .npy file of source features, domain label 1.
+        target_feature_path (string): .npy file of target features, domain label 0.
+        source_index (array, optional): rows of the source file to use, all of them by default.
+        train_size (float): fraction of the rows used for training, the rest is the test split.
+    """
+
+    def __init__(self, source_feature_path, target_feature_path, source_index=None, train_size=0.8):
+        self.source_feature = np.load(source_feature_path, mmap_mode="r")
+        self.target_feature = np.load(target_feature_path, mmap_mode="r")
+        if source_index is None:
+            source_index = np.arange(self.source_feature.shape[0])
+        self.N_s = len(source_index)
+        self.N_t = self.target_feature.shape[0]
+        # rows past the end of the source file address the target file
+        index = np.concatenate((np.asarray(source_index, dtype=np.int64),
+                                np.arange(self.N_t, dtype=np.int64) + self.source_feature.shape[0]))
+        np.random.shuffle(index)
+        split = int(len(index) * train_size)
+        self.train_index = index[:split]
+        self.test_index = index[split:]
+
+    def gather(self, index):
+        # sorted rows give sequential reads on the memory map
+        index = np.sort(index)
+        is_source = index < self.source_feature.shape[0]
+        feature = np.concatenate((self.source_feature[index[is_source]],
+                                  self.target_feature[index[~is_source] - self.source_feature.shape[0]]))
+        label = np.concatenate((np.ones(is_source.sum(), dtype=np.int64),
+                                np.zeros((~is_source).sum(), dtype=np.int64)))
+        return np.asarray(feature, dtype=np.float32), label
+
+    def batches(self, index, batch_size, shuffle):
+        if shuffle:
+            index = index[np.random.permutation(len(index))]
+        for start in range(0, len(index), batch_size):
+            yield self.gather(index[start:start + batch_size])
+
+
+def streaming_accuracy(model, stream, batch_size, prefetch_size, device):
+    correct = np.zeros(model.n_model)
+    with torch.no_grad():
+        for feature, label in prefetch(stream.batches(stream.test_index, batch_size, False), prefetch_size):
+            pred = model(torch.from_numpy(feature).to(device))
+            label = torch.from_numpy(label).to(device)
+            correct += (torch.max(pred, 2)[1] == label.view(1, -1)).sum(1).cpu().numpy()
+    return correct / len(stream.test_index)
+
+
+def train_domain_classifiers_streaming(stream, decays, batch_size=256, epochs=10, prefetch_size=4, lr=0.001,
+                                       use_gpu=None):
+    """
+    Same as train_domain_classifiers, but the training set is read from a FeatureStream in shuffled mini-batches
+    :param stream: FeatureStream
+    :param decays: list of weight decays, one model each
+    :param batch_size: rows per mini-batch
+    :param epochs: number of passes over the training split
+    :param prefetch_size: mini-batches read ahead by the background thread
+    :param lr:
+    :param use_gpu: defaults to torch.cuda.is_available()
+    :return: the mlp_network.MLP with the best test accuracy, and the test accuracy of every decay
+    """
+    if use_gpu is None:
+        use_gpu = torch.cuda.is_available()
+    device = torch.device("cuda" if use_gpu else "cpu")
+    n_model = len(decays)
+    d = stream.source_feature.shape[1]
+
+    model = mlp_network.BatchedMLP(n_model, d, 2).to(device)
+    decay = torch.tensor(decays, dtype=torch.float32, device=device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+
+    for ep in range(1, epochs + 1):
+        for feature, label in prefetch(stream.batches(stream.train_index, batch_size, True), prefetch_size):
+            feature = torch.from_numpy(feature).to(device)
+            label = torch.from_numpy(label).to(device)
+            pred = model(feature)
+            loss = F.cross_entropy(pred.reshape(-1, 2), label.repeat(n_model), reduction='none')
+            loss = loss.view(n_model, -1).mean(1).sum()
+            optimizer.zero_grad()
+            loss.backward()
+            add_weight_decay(model, decay)
+            optimizer.step()
+        print("Epoch {}, accuracy is {}".format(ep, streaming_accuracy(model, stream, batch_size, prefetch_size,
+                                                                       device)))
+
+    val_acc = streaming_accuracy(model, stream, batch_size, prefetch_size, device)
+    index = int(np.argmax(val_acc))
+    print("Decay {} is the best, accuracy is {}".format(decays[index], val_acc[index]))
+    return model.extract(index), list(val_acc)
+
+
+def get_weight_streaming(source_feature_path, target_feature_path, validation_feature_path, decays,
+                         batch_size=256, epochs=10, prefetch_size=4, max_ratio=None, use_gpu=None):
+    """
+    Importance weight of every validation sample, without ever loading a whole feature file
+    :param max_ratio: when there are more than max_ratio times as many source as target rows,
+    use max_ratio * N_t random source rows
+    :return: shape [N_v, 1], (Ntr/Nts)*(1-M(fv))/M(fv)
+    """
+    N_s = np.load(source_feature_path, mmap_mode="r").shape[0]
+    N_t = np.load(target_feature_path, mmap_mode="r").shape[0]
+    source_index = None
+    if max_ratio is not None and float(N_s) / N_t > max_ratio:
+        source_index = subsample.random_select_index(N_s, int(max_ratio * N_t))
+    stream = FeatureStream(source_feature_path, target_feature_path, source_index)
+    print('num_source is {}, num_target is {}, ratio is {}\n'.format(stream.N_s, stream.N_t,
+                                                                     float(stream.N_s) / stream.N_t))
+    best_mlp, _ = train_domain_classifiers_streaming(stream, decays, batch_size, epochs, prefetch_size,
+                                                     use_gpu=use_gpu)
+    device = next(best_mlp.parameters()).device
+
+    validation_feature = np.load(validation_feature_path, mmap_mode="r")
+    domain_out = []
+    with torch.no_grad():
+        for start in range(0, validation_feature.shape[0], batch_size):
+            feature = np.asarray(validation_feature[start:start + batch_size], dtype=np.float32)
+            out = F.softmax(best_mlp(torch.from_numpy(feature).to(device)), dim=1)
+            domain_out.append(out.cpu().numpy())
+    domain_out = np.concatenate(domain_out)
+    return domain_out[:, :1] / domain_out[:, 1:] * stream.N_s * 1.0 / stream.N_t  # (Ntr/Nts)*(1-M(fv))/M(fv)
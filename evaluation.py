@@ -0,0 +1,61 @@
+import torch
+import torch.nn as nn
+
+
+class StreamingEvaluator(object):
+    """Running classification statistics, updated batch by batch into buffers allocated once.
+
+    Memory does not grow with the number of evaluated samples: only a [C, C] confusion matrix and a [C]
+    softmax sum are kept, on the device of the first batch.
+    Args:
+        n_view (int): consecutive rows of the model output belonging to the same sample, e.g. 10 for
+            the views of prep.image_test_10view, their softmax outputs are summed.
+        softmax_param (float): scale applied to the outputs before the softmax.
+    """
+
+    def __init__(self, n_view=1, softmax_param=1.0):
+        self.n_view = n_view
+        self.softmax_param = softmax_param
+        self.confusion = None
+        self.softmax_sum = None
+        self.count = 0
+
+    def update(self, outputs, labels=None):
+        """
+        :param outputs: shape [B * n_view, C], model outputs
+        :param labels: shape [B], ground truth class, optional when only the softmax is needed
+        """
+        outputs = outputs.detach()
+        if self.softmax_sum is None:
+            class_num = outputs.size(1)
+            self.confusion = torch.zeros(class_num * class_num, dtype=torch.long, device=outputs.device)
+            self.softmax_sum = torch.zeros(class_num, dtype=torch.float, device=outputs.device)
+        softmax_outputs = nn.Softmax(dim=1)(self.softmax_param * outputs.float())
+        softmax_outputs = softmax_outputs.view(-1, self.n_view, softmax_outputs.size(1)).sum(1)
+        self.softmax_sum += softmax_outputs.sum(0)
+        self.count += softmax_outputs.size(0)
+        if labels is not None:
+            if self.n_view == 1:
+                # argmax of the raw outputs, the same as argmax of their softmax
+                _, predict = torch.max(outputs, 1)
+            else:
+                _, predict = torch.max(softmax_outputs, 1)
+            index = labels.detach().to(outputs.device).long() * self.softmax_sum.size(0) + predict
+            self.confusion.index_add_(0, index, torch.ones_like(index))
+
+    def confusion_matrix(self):
+        """
+        :return: shape [C, C], row is the ground truth class and column the predicted class
+        """
+        class_num = self.softmax_sum.size(0)
+        return self.confusion.view(class_num, class_num)
+
+    def accuracy(self):
+        confusion = self.confusion_matrix()
+        return confusion.diag().sum().item() / float(confusion.sum().item())
+
+    def mean_softmax(self):
+        """
+        :return: shape [C], the softmax output of every sample, summed over its views, averaged over all samples
+        """
+        return self.softmax_sum / self.count
@@ -0,0 +1,133 @@
+import contextlib
+
+import numpy as np
+import torch
+import torch.utils.data as util_data
+from data_list import ImageList, decode_mode
+from crop_cache import CropCache
+import pre_process as prep
+
+
+def inference_mode():
+    # torch.inference_mode only exists from torch 1.9 on
+    if hasattr(torch, "inference_mode"):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+@contextlib.contextmanager
+def eval_mode(networks):
+    """
+    Put networks in eval mode and back in their previous mode on exit, so extracted features do not depend on
+    the batch and the BatchNorm running statistics, part of the feature store key, do not move
+    """
+    training = [network.training for network in networks]
+    for network in networks:
+        network.eval()
+    try:
+        yield
+    finally:
+        for network, mode in zip(networks, training):
+            network.train(mode)
+
+
+def forward_pair(feature_network, predict_network):
+    """
+    Forward function for networks returning (feature, prediction score) tuples
+    :param feature_network: network whose first output is the feature
+    :param predict_network: network whose second output is the prediction score
+    :return: callable mapping an input batch to (features, prediction scores); when both networks are the same
+    module, as in the training scripts, the backbone only runs once
+    """
+    if predict_network is feature_network:
+        return feature_network
+
+    def forward(inputs):
+        feature, _ = feature_network(inputs)
+        _, score = predict_network(inputs)
+        return feature, score
+    return forward
+
+
+def forward_stacked(G, F1):
+    """
+    Forward function for a feature network G followed by a classifier F1 fed with its output
+    :return: callable mapping an input batch to (features, prediction scores), G runs once per batch
+    """
+    def forward(inputs):
+        feature = G(inputs)
+        return feature, F1(feature)
+    return forward
+
+
+def dev_transform(resize_size, crop_size, deterministic=False, crop_cache=None):
+    """
+    Input pipeline of DEV extraction
+    :param deterministic: use the center crop of prep.image_test instead of the random crops of prep.image_train,
+    so features are reproducible and can be reused across runs
+    :param crop_cache: optional directory caching the uint8 crops of every image list, implies deterministic
+    :return: prep_dict for extract_feature, either a transform or a CropCache, and its json description
+    """
+    # the decode mode changes the pixels, so it is part of the feature store key
+    transform_config = {"transform": "image_test", "resize_size": resize_size, "crop_size": crop_size}
+    transform_config.update(decode_mode())
+    if crop_cache:
+        return CropCache(crop_cache, resize_size, crop_size), transform_config
+    if deterministic:
+        return prep.image_test(resize_size=resize_size, crop_size=crop_size), transform_config
+    transform_config["transform"] = "image_train"
+    return prep.image_train(resize_size=resize_size, crop_size=crop_size), transform_config
+
+
+def iterate_feature(forward, image_list, prep_dict, batch_size, use_gpu, networks=()):
+    """
+    Run an image list through forward, one batch at a time and in list order
+    :param forward: callable from forward_pair or forward_stacked
+    :param image_list: list of "path label" lines
+    :param prep_dict: transform applied to every image, or a CropCache serving preprocessed crops
+    :param batch_size:
+    :param use_gpu:
+    :param networks: networks behind forward, kept in eval mode while iterating
+    :return: generator of numpy (features [n, d], prediction scores [n, C], labels [n])
+    """
+    if isinstance(prep_dict, CropCache):
+        dsets = prep_dict.dataset(image_list)
+    else:
+        dsets = ImageList(image_list, transform=prep_dict)
+    dset_loaders = util_data.DataLoader(dsets, batch_size=batch_size, shuffle=False, num_workers=4)
+    with eval_mode(networks), inference_mode():
+        for inputs, label in dset_loaders:
+            if use_gpu:
+                inputs = inputs.cuda()
+            feature, score = forward(inputs)
+            yield feature.cpu().numpy(), score.cpu().numpy(), label.numpy()
+
+
+def extract_feature(forward, networks, image_list, prep_dict, batch_size, use_gpu, feature_store=None,
+                    transform_config=None):
+    """
+    Run an image list through forward exactly once
+    :param forward: callable from forward_pair or forward_stacked
+    :param networks: list of the networks behind forward, part of the feature store key
+    :param feature_store: optional feature_store.FeatureStore, the backbone is skipped on a hit
+    :param transform_config: json serializable description of prep_dict, part of the store key
+    :return: features [N, d], prediction scores [N, C] and labels [N] as numpy arrays, in list order
+    """
+    # in eval mode before the store key is computed, so the key and the features do not depend on the batches
+    with eval_mode(networks):
+        if feature_store is not None and feature_store.incremental:
+            return feature_store.get_or_extract_lines(networks, image_list, transform_config,
+                                                      lambda lines: extract_feature(forward, networks, lines,
+                                                                                    prep_dict, batch_size, use_gpu))
+        if feature_store is not None:
+            return feature_store.get_or_extract(networks, image_list, transform_config,
+                                                lambda: extract_feature(forward, networks, image_list, prep_dict,
+                                                                        batch_size, use_gpu))
+        features = []
+        scores = []
+        labels = []
+        for feature, score, label in iterate_feature(forward, image_list, prep_dict, batch_size, use_gpu, networks):
+            features.append(feature)
+            scores.append(score)
+            labels.append(label)
+        return np.concatenate(features), np.concatenate(scores), np.concatenate(labels)
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+def network_digest(networks, digest):
+    """
+    Feed the weights of every network into a hash, in a fixed order
+    :param networks: list of torch modules, duplicates are only hashed once
+    :param digest: hashlib object to update
+    """
+    seen = []
+    for network in networks:
+        if any(network is other for other in seen):
+            continue
+        seen.append(network)
+        state_dict = network.state_dict()
+        for name in sorted(state_dict.keys()):
+            digest.update(name.encode("utf-8"))
+            digest.update(state_dict[name].detach().cpu().numpy().tobytes())
+
+
+class FeatureStore(object):
+    """Content-addressed on-disk store for the features, prediction scores and labels used by DEV.
+
+    Every entry lives in ``root/<key>/`` where the key is a hash of the network weights, the image list
+    contents and the transform config, so re-scoring the same snapshot on the same lists never touches
+    the backbone again. Features are kept as float16 or float32 ``.npy`` files and are memory-mapped on load.
+    In incremental mode entries are keyed by the networks and the transform only, and hold the features of
+    individual lines, so when lines are appended to a list only the new lines are extracted.
+    Args:
+        root (string): directory holding the entries.
+        dtype (string): ``"float32"`` or ``"float16"``, the dtype features are stored with.
+        incremental (bool): reuse stored features line by line instead of list by list.
+    """
+
+    def __init__(self, root, dtype="float32", incremental=False):
+        assert dtype in ("float32", "float16"), "features are stored as float32 or float16"
+        self.root = root
+        self.dtype = dtype
+        self.incremental = incremental
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def key(self, networks, image_list, transform_config):
+        """
+        :param networks: list of networks the features and scores come from
+        :param image_list: list of "path label" lines, in extraction order
+        :param transform_config: json serializable description of the transform
+        :return: hex digest identifying the entry
+        """
+        digest = hashlib.sha1()
+        network_digest(networks, digest)
+        for line in image_list:
+            digest.update(line.strip().encode("utf-8"))
+            digest.update(b"\n")
+        digest.update(json.dumps(transform_config, sort_keys=True).encode("utf-8"))
+        digest.update(self.dtype.encode("utf-8"))
+        return digest.hexdigest()
+
+    def model_key(self, networks, transform_config):
+        """
+        :return: hex digest of the networks and the transform, without the image list
+        """
+        digest = hashlib.sha1()
+        network_digest(networks, digest)
+        digest.update(json.dumps(transform_config, sort_keys=True).encode("utf-8"))
+        digest.update(self.dtype.encode("utf-8"))
+        return digest.hexdigest()
+
+    def load(self, key):
+        """
+        :return: memory-mapped (feature [N, d], score [N, C], label [N]), or None if the key is missing
+        """
+        path = os.path.join(self.root, key)
+        if not os.path.exists(path):
+            return None
+        return (np.load(os.path.join(path, "feature.npy"), mmap_mode="r"),
+                np.load(os.path.join(path, "score.npy"), mmap_mode="r"),
+                np.load(os.path.join(path, "label.npy"), mmap_mode="r"))
+
+    def save(self, key, feature, score, label, image_list=None):
+        """
+        :param key: entry name, may contain a sub directory
+        :param image_list: lines the rows belong to, stored with the entry in incremental mode
+        """
+        path = os.path.join(self.root, key)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # written into a temporary directory first so a crash never leaves a half entry behind
+        tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path))
+        np.save(os.path.join(tmp_path, "feature.npy"), np.asarray(feature, dtype=self.dtype))
+        np.save(os.path.join(tmp_path, "score.npy"), np.asarray(score, dtype=np.float32))
+        np.save(os.path.join(tmp_path, "label.npy"), np.asarray(label))
+        if image_list is not None:
+            with open(os.path.join(tmp_path, "list.txt"), "w") as f:
+                for line in image_list:
+                    f.write(line.strip() + "\n")
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # somebody else stored the same entry meanwhile
+            shutil.rmtree(tmp_path)
+
+    def get_or_extract(self, networks, image_list, transform_config, extract):
+        """
+        :param extract: callable returning (feature, score, label), only called on a miss
+        :return: (feature, score, label)
+        """
+        key = self.key(networks, image_list, transform_config)
+        entry = self.load(key)
+        if entry is not None:
+            print("Loaded stored feature {}".format(key))
+            return entry
+        self.save(key, *extract())
+        return self.load(key)
+
+    def get_or_extract_lines(self, networks, image_list, transform_config, extract):
+        """
+        Incremental get_or_extract, every stored line is reused and only the others are extracted
+        :param extract: callable taking a list of lines and returning their (feature, score, label)
+        :return: (feature, score, label) of image_list, in list order
+        """
+        model_key = self.model_key(networks, transform_config)
+        model_path = os.path.join(self.root, model_key)
+        segments = []
+        row_of = {}
+        if os.path.exists(model_path):
+            for name in sorted(os.listdir(model_path)):
+                list_path = os.path.join(model_path, name, "list.txt")
+                # temporary directories of entries still being written are skipped
+                if name.startswith("tmp") or not os.path.exists(list_path):
+                    continue
+                with open(list_path) as f:
+                    for row, line in enumerate(f):
+                        row_of[line.rstrip("\n")] = (len(segments), row)
+                segments.append(self.load(os.path.join(model_key, name)))
+        missing = []
+        for line in image_list:
+            if line.strip() not in row_of:
+                row_of[line.strip()] = None
+                missing.append(line)
+        if missing:
+            print("Extracting {} of {} lines".format(len(missing), len(image_list)))
+            key = os.path.join(model_key, self.key([], missing, transform_config))
+            self.save(key, *extract(missing), image_list=missing)
+            entry = self.load(key)
+            for row, line in enumerate(missing):
+                row_of[line.strip()] = (len(segments), row)
+            segments.append(entry)
+        else:
+            print("Loaded stored feature {}".format(model_key))
+        # gather every segment's rows with one fancy index each
+        where = np.array([row_of[line.strip()] for line in image_list], dtype=np.int64).reshape(-1, 2)
+        result = []
+        for part in range(3):
+            out = np.empty((len(where),) + segments[0][part].shape[1:], dtype=segments[0][part].dtype)
+            for i, segment in enumerate(segments):
+                mask = where[:, 0] == i
+                if mask.any():
+                    out[mask] = segment[part][where[mask, 1]]
+            result.append(out)
+        return tuple(result)
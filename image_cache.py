@@ -0,0 +1,139 @@
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from data_list import decode_loader, decode_mode
+
+
+class SharedImageCache(object):
+    """Decoded-image cache shared by every process of a machine, with a byte budget and LRU eviction.
+
+    Images are kept as uint8 ``.npy`` files in a directory that should live on a RAM-backed file system such as
+    ``/dev/shm``, so DataLoader workers, the several loaders of one ``train()`` call and the DEV loaders all find
+    an image decoded by any of them. A hit refreshes the file time, and the least recently used files are
+    removed when the cache grows over its budget. The bytes in the cache are counted in a ``usage`` file updated
+    under a lock by every inserting process, so the budget holds for all of them together. An image that cannot
+    be written, e.g. with ``/dev/shm`` full, is simply returned uncached. Use it as the ``loader`` of an
+    ImageList or install it for every ImageList with ``data_list.set_image_cache``.
+    Args:
+        root (string): directory holding the decoded images.
+        max_bytes (int): budget of the cache.
+        resize_size (int, optional): images are stored resized to (resize_size, resize_size), as ResizeImage
+            does, so the transforms resize them again at no cost.
+        loader (callable): decodes the images missing from the cache into PIL images, by default with the
+            selected data_list decode backend.
+    """
+
+    def __init__(self, root="/dev/shm/dev_image_cache", max_bytes=4 * 1024 ** 3, resize_size=None,
+                 loader=decode_loader):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.resize_size = resize_size
+        self.loader = loader
+        if not os.path.exists(root):
+            try:
+                os.makedirs(root)
+            except OSError:
+                # created by another process meanwhile
+                pass
+
+    def path(self, image_path):
+        # the file time and size are part of the key, so an image rewritten at the same path is decoded again,
+        # and so is the decode mode, so draft and full decodes, or two backends, never share an entry
+        stat = os.stat(image_path)
+        digest = hashlib.sha1("{} {} {} {} {}".format(image_path, stat.st_mtime, stat.st_size, self.resize_size,
+                                                      json.dumps(decode_mode(), sort_keys=True)).encode("utf-8"))
+        return os.path.join(self.root, digest.hexdigest() + ".npy")
+
+    def contains(self, image_path):
+        return os.path.exists(self.path(image_path))
+
+    def __call__(self, image_path):
+        cache_path = self.path(image_path)
+        try:
+            array = np.load(cache_path)
+            os.utime(cache_path, None)
+            return Image.fromarray(array)
+        except (IOError, OSError, ValueError):
+            # not cached yet, or evicted by another process while being read
+            pass
+        img = self.loader(image_path)
+        if self.resize_size is not None:
+            img = img.resize((self.resize_size, self.resize_size))
+        self.put(cache_path, np.asarray(img, dtype=np.uint8))
+        return img
+
+    def put(self, cache_path, array):
+        if array.nbytes > self.max_bytes:
+            return
+        tmp_path = None
+        try:
+            # the usage file holds the bytes in the cache, its lock serializes inserts and evictions
+            fd = os.open(os.path.join(self.root, "usage"), os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                usage = os.read(fd, 32)
+                used = int(usage) if usage else None
+                if used is None or used + array.nbytes > self.max_bytes:
+                    # evict a bit more than needed so the directory is not scanned again on every insert
+                    used = self.evict(int(0.9 * self.max_bytes) - array.nbytes)
+                # written to a temporary file first so other processes never load half an image
+                tmp_fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.root)
+                with os.fdopen(tmp_fd, "wb") as f:
+                    np.save(f, array)
+                size = os.path.getsize(tmp_path)
+                os.rename(tmp_path, cache_path)
+                tmp_path = None
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, str(used + size).encode("utf-8"))
+            finally:
+                os.close(fd)
+        except (IOError, OSError):
+            # cache directory full or not writable, the image is used uncached
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+    def evict(self, budget):
+        """
+        Remove least recently used images until the cache holds at most budget bytes, called with the usage lock
+        :return: bytes left in the cache
+        """
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith(".tmp"):
+                # left behind by a process killed while writing, any live write takes well under a minute
+                if stat.st_mtime < now - 60:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                continue
+            if name.endswith(".npy"):
+                entries.append((stat.st_mtime, stat.st_size, name))
+        used = sum(size for _, size, _ in entries)
+        entries.sort()
+        for _, size, name in entries:
+            if used <= budget:
+                break
+            try:
+                os.remove(os.path.join(self.root, name))
+            except OSError:
+                pass
+            used -= size
+        return used
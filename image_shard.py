@@ -0,0 +1,159 @@
+import argparse
+import json
+import os
+import tempfile
+
+import numpy as np
+import torch
+import torch.utils.data as util_data
+from PIL import Image
+
+from data_list import ImageList, ImageIndex
+import pre_process as prep
+
+
+def to_uint8_array(img):
+    # HWC uint8 tensor of a PIL image, collated by the default DataLoader collate
+    return torch.from_numpy(np.array(img, dtype=np.uint8))
+
+
+def pack_shards(image_list, root, size=256, shard_size=4096, batch_size=64, num_workers=4):
+    """
+    Decode an image list once into fixed-size uint8 shards
+    Every image is resized to (size, size) as prep.ResizeImage does and stored in ``root/shard-XXXXX.npy``,
+    arrays of shape [shard_size, size, size, 3], the last one shorter. ``root/list.txt`` keeps the packed lines
+    with their labels, in row order, and ``root/index.json`` the geometry. The index is written last, so a
+    half-packed directory is never read.
+    :param image_list: list of "path label" lines, lines with an already packed path are skipped
+    :param root: output directory
+    :param size: side of the stored images, the resize_size of the pipelines reading them
+    :param shard_size: images per shard file
+    """
+    if not os.path.exists(root):
+        os.makedirs(root)
+    lines = []
+    seen = set()
+    for line in image_list:
+        path = line.split()[0]
+        if path not in seen:
+            seen.add(path)
+            lines.append(line.strip())
+    dsets = ImageList(lines, transform=prep.transforms.Compose([prep.ResizeImage(size), to_uint8_array]))
+    dset_loaders = util_data.DataLoader(dsets, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    shard = None
+    row = 0
+    for inputs, _ in dset_loaders:
+        inputs = inputs.numpy()
+        start = 0
+        while start < len(inputs):
+            offset = row % shard_size
+            if offset == 0:
+                # written next to the shard first so a crash never leaves a half shard behind
+                fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=root)
+                os.close(fd)
+                shard = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8,
+                                                  shape=(min(shard_size, len(lines) - row), size, size, 3))
+            count = min(len(inputs) - start, len(shard) - offset)
+            shard[offset:offset + count] = inputs[start:start + count]
+            start += count
+            row += count
+            if offset + count == len(shard):
+                shard.flush()
+                shard = None
+                os.rename(tmp_path, shard_path(root, (row - 1) // shard_size))
+    with open(os.path.join(root, "list.txt"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+    with open(os.path.join(root, "index.json"), "w") as f:
+        json.dump({"size": size, "shard_size": shard_size, "count": len(lines)}, f)
+
+
+def shard_path(root, shard):
+    return os.path.join(root, "shard-{:05d}.npy".format(shard))
+
+
+class ShardImageList(ImageList):
+    """ImageList reading images packed by pack_shards straight out of memory-mapped shards.
+
+    No file is opened and no image decoded per sample: a sample is a slice of a shard, mapped once per process,
+    handed to the transform as a PIL image of the packed size. With the packed size equal to resize_size, the
+    ResizeImage step of the prep pipelines keeps the image as is.
+    Args:
+        root (string): directory written by pack_shards.
+        image_list (list, optional): "path label" lines to serve, every path must be packed, labels are taken from
+            these lines. Defaults to every packed line.
+        labels (array, optional): label matrix of shape [N, L], row i belongs to image_list[i].
+        transform (callable, optional): A function/transform that takes in an PIL image
+            and returns a transformed version. E.g, ``transforms.RandomCrop``
+        target_transform (callable, optional): A function/transform that takes in the
+            target and transforms it.
+        num_threads (int): threads reading the images of a batch fetched with a list of indices.
+        resize_size (int, optional): resize_size of the transform, checked against the packed size so images
+            are never resampled a second time.
+    """
+
+    def __init__(self, root, image_list=None, labels=None, transform=None, target_transform=None, num_threads=0,
+                 resize_size=None):
+        with open(os.path.join(root, "index.json")) as f:
+            index = json.load(f)
+        assert resize_size is None or index["size"] == resize_size, \
+            "{} is packed at size {}, the transform resizes to {}".format(root, index["size"], resize_size)
+        packed = ImageIndex(open(os.path.join(root, "list.txt")).readlines())
+        if image_list is None:
+            imgs = packed
+            rows = np.arange(len(packed), dtype=np.int64)
+        else:
+            imgs = ImageIndex(image_list, labels)
+            row_of = dict((packed.path(i), i) for i in range(len(packed)))
+            try:
+                rows = np.array([row_of[imgs.path(i)] for i in range(len(imgs))], dtype=np.int64)
+            except KeyError as e:
+                raise RuntimeError("Image not packed in " + root + ": " + str(e))
+        self.root = root
+        self.size = index["size"]
+        self.shard_size = index["shard_size"]
+        self.imgs = imgs
+        self.rows = rows
+        self.transform = transform
+        self.target_transform = target_transform
+        self.loader = None
+        self.num_threads = num_threads
+        self.pool = None
+        self.shards = {}
+
+    def __getstate__(self):
+        # memory maps are opened again in every process instead of being pickled with their contents
+        state = ImageList.__getstate__(self)
+        state["shards"] = {}
+        return state
+
+    def shard(self, shard):
+        if shard not in self.shards:
+            self.shards[shard] = np.load(shard_path(self.root, shard), mmap_mode="r")
+        return self.shards[shard]
+
+    def load(self, index):
+        row = self.rows[index]
+        img = Image.fromarray(np.array(self.shard(row // self.shard_size)[row % self.shard_size]))
+        target = self.imgs.target(index)
+        if self.transform is not None:
+            img = self.transform(img)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+
+        return img, target
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pack image lists into memory-mappable shards')
+    parser.add_argument('list_paths', type=str, nargs='+', help="image lists to pack, shared paths are packed once")
+    parser.add_argument('--output_dir', type=str, required=True, help="directory receiving the shards")
+    parser.add_argument('--size', type=int, default=256, help="side of the stored images, the prep resize_size")
+    parser.add_argument('--shard_size', type=int, default=4096, help="images per shard file")
+    parser.add_argument('--num_workers', type=int, default=4, help="decoding processes")
+    args = parser.parse_args()
+
+    image_list = []
+    for list_path in args.list_paths:
+        image_list.extend(open(list_path).readlines())
+    pack_shards(image_list, args.output_dir, size=args.size, shard_size=args.shard_size,
+                num_workers=args.num_workers)
@@ -1,3 +1,4 @@
+import math
 import torch
 import torch.nn.functional as F
 
@@ -15,3 +16,40 @@ class MLP(torch.nn.Module):
     def forward(self, x):
         x = self.layer(x)
         return x
+
+class BatchedMLP(torch.nn.Module):
+    """n_model independent copies of MLP whose parameters are stacked along a leading model axis,
+    so all of them run in one bmm per layer"""
+    def __init__(self, n_model, n_feature, out_dim):
+        super(BatchedMLP, self).__init__()
+        self.n_model = n_model
+        self.weights = torch.nn.ParameterList()
+        self.biases = torch.nn.ParameterList()
+        for fan_in, fan_out in [(n_feature, n_feature), (n_feature, n_feature), (n_feature, out_dim)]:
+            # same initialization as torch.nn.Linear
+            bound = 1.0 / math.sqrt(fan_in)
+            self.weights.append(torch.nn.Parameter(torch.Tensor(n_model, fan_in, fan_out).uniform_(-bound, bound)))
+            self.biases.append(torch.nn.Parameter(torch.Tensor(n_model, 1, fan_out).uniform_(-bound, bound)))
+
+    def forward(self, x):
+        # x is [N, d] shared by every model, or [n_model, N, d]
+        if x.dim() == 2:
+            x = x.unsqueeze(0).expand(self.n_model, x.size(0), x.size(1))
+        for i in range(len(self.weights)):
+            x = torch.baddbmm(self.biases[i], x, self.weights[i])
+            if i < len(self.weights) - 1:
+                x = F.relu(x)
+        return x
+
+    def extract(self, index):
+        """
+        :param index: which of the stacked models to copy out
+        :return: an MLP holding the weights of that model
+        """
+        mlp = MLP(self.weights[0].size(1), self.weights[-1].size(2)).to(self.weights[0].device)
+        linears = [mlp.layer[0], mlp.layer[2], mlp.layer[4]]
+        with torch.no_grad():
+            for i, linear in enumerate(linears):
+                linear.weight.copy_(self.weights[i][index].t())
+                linear.bias.copy_(self.biases[i][index].view(-1))
+        return mlp
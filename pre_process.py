@@ -4,6 +4,7 @@ import os
 from PIL import Image, ImageOps
 import numbers
 import torch
+from torch.utils.data.dataloader import default_collate
 
 class ResizeImage():
     def __init__(self, size):
@@ -151,3 +152,97 @@ def image_test_10crop(resize_size=256, crop_size=224):
   ])
   return data_transforms
 
+
+class TenCrop(object):
+    """Cut the ten views of image_test_10crop out of one resized and normalized image.
+    Args:
+        resize_size (int): size the image was resized to.
+        crop_size (int): size of every view.
+    """
+
+    def __init__(self, resize_size=256, crop_size=224):
+        start_first = 0
+        start_center = (resize_size - crop_size - 1) / 2
+        start_last = resize_size - crop_size - 1
+        # (start_x, start_y) of val0-val4 on the flipped image and of val5-val9 on the image itself,
+        # rounded like PIL.Image.crop does for PlaceCrop
+        starts = [(start_first, start_first), (start_last, start_last), (start_last, start_first),
+                  (start_first, start_last), (start_center, start_center)]
+        self.starts = [(int(round(x)), int(round(y))) for x, y in starts]
+        self.crop_size = crop_size
+
+    def __call__(self, tensor):
+        """
+        Args:
+            tensor (Tensor): image of shape [C, H, W].
+        Returns:
+            Tensor: the ten views, shape [10, C, crop_size, crop_size], in the order of val0 to val9.
+        """
+        flipped = tensor.index_select(2, torch.arange(tensor.size(2) - 1, -1, -1).long())
+        views = []
+        for img in (flipped, tensor):
+            for x, y in self.starts:
+                views.append(img[:, y:y + self.crop_size, x:x + self.crop_size])
+        return torch.stack(views)
+
+def image_test_10view(resize_size=256, crop_size=224):
+  #decode and resize once, then cut all ten views of image_test_10crop, use with collate_views
+  normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                                   std=[0.229, 0.224, 0.225])
+  return transforms.Compose([
+    ResizeImage(resize_size),
+    transforms.ToTensor(),
+    normalize,
+    TenCrop(resize_size, crop_size)
+  ])
+
+def collate_views(batch):
+  #stack a batch of multi-view samples [V, C, H, W] into one [B * V, C, H, W] batch, the V views of a sample
+  #are consecutive. Single view samples are collated as usual
+  inputs, labels = default_collate(batch)
+  if inputs.dim() == 5:
+    inputs = inputs.view(-1, *inputs.size()[2:])
+  return inputs, labels
+
+
+class ToUint8Tensor(object):
+    """Convert a PIL.Image to a uint8 tensor of shape [C, H, W], without scaling it to [0, 1]."""
+
+    def __call__(self, img):
+        """
+        Args:
+            img (PIL.Image): Image to be converted.
+        Returns:
+            Tensor: uint8 image.
+        """
+        return torch.from_numpy(np.array(img, dtype=np.uint8).transpose(2, 0, 1).copy())
+
+
+class NormalizeUint8(object):
+    """Scale a uint8 tensor to [0, 1] and normalize it, the same as ToTensor followed by Normalize."""
+
+    def __init__(self, mean, std):
+        self.mean = torch.FloatTensor(mean).view(-1, 1, 1)
+        self.std = torch.FloatTensor(std).view(-1, 1, 1)
+
+    def __call__(self, tensor):
+        """
+        Args:
+            tensor (Tensor): uint8 image of shape [C, H, W].
+        Returns:
+            Tensor: normalized float image.
+        """
+        return (tensor.float().div(255) - self.mean) / self.std
+
+def image_test_uint8(resize_size=256, crop_size=224):
+  #the deterministic center crop of image_test, kept as uint8 so it can be cached
+  start_center = (resize_size - crop_size - 1) / 2
+  return transforms.Compose([
+    ResizeImage(resize_size),
+    PlaceCrop(crop_size, start_center, start_center),
+    ToUint8Tensor()
+  ])
+
+def normalize_uint8():
+  return NormalizeUint8(mean=[0.485, 0.456, 0.406],
+                        std=[0.229, 0.224, 0.225])
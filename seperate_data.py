@@ -1,31 +1,178 @@
+import bisect
+import hashlib
+import itertools
 import math
+import os
+import struct
+import numpy as np
+from data_list import ImageIndex
 
-def split_set(source_path, class_num, split = 0.4):
+def hash_fraction(path, seed = 0):
+    """
+    Stable pseudo-random number in [0, 1) of an image path, the same in every run and on every machine
+    :param path:
+    :param seed:
+    :return:
+    """
+    digest = hashlib.md5("{} {}".format(seed, path).encode("utf-8")).digest()
+    return struct.unpack(">Q", digest[:8])[0] / float(2 ** 64)
+
+def manifest_path(source_path, split, seed):
+    return "{}.split-{}-{}".format(source_path, split, seed)
+
+def load_manifest(path):
+    """
+    :param path: manifest written by save_manifest
+    :return: dict from image path to True for validation and False for source, empty if there is no manifest
+    """
+    assignment = {}
+    if not os.path.exists(path):
+        return assignment
+    with open(path) as f:
+        for line in f:
+            side, image_path = line.rstrip("\n").split(" ", 1)
+            assignment[image_path] = side == "val"
+    return assignment
+
+def save_manifest(path, assignment):
+    """
+    One "src path" or "val path" line per image, written to a temporary file first so readers never see half
+    :param path:
+    :param assignment: dict from image path to True for validation
+    :return:
+    """
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        for image_path in sorted(assignment):
+            f.write("{} {}\n".format("val" if assignment[image_path] else "src", image_path))
+    os.rename(tmp_path, path)
+
+def split_index(image_index, class_num, split = 0.4, mode = "tail", seed = 0, assignment = None):
+    """
+    Bucket the images by class in one pass and pick the validation images of every class by index
+    :param image_index: data_list.ImageIndex of the source list
+    :param class_num:
+    :param split: fraction of every class used for validation
+    :param mode: "tail" takes the last images of every class, last one first, as split_set always did,
+    "random" takes a random subset of every class drawn with seed,
+    "hash" sends an image to validation when hash_fraction(path, seed) < split, so where an image goes
+    does not depend on the rest of the list
+    :param seed:
+    :param assignment: hash mode only, dict from image path to True for validation, paths found there are not
+    hashed again and new paths are added to it
+    :return: list of class_num source index arrays and list of class_num validation index arrays
+    """
+    if mode not in ("tail", "random", "hash"):
+        raise ValueError("unknown split mode {}".format(mode))
+    if assignment is None:
+        assignment = {}
+    class_index = image_index.class_index()
+    random_state = np.random.RandomState(seed)
+    src_index = []
+    val_index = []
+    for i in range(class_num):
+        index = class_index.get(i, np.zeros(0, dtype=np.int64))
+        if mode == "hash":
+            is_val = np.zeros(len(index), dtype=bool)
+            for n, k in enumerate(index):
+                path = image_index.path(k)
+                if path not in assignment:
+                    assignment[path] = hash_fraction(path, seed) < split
+                is_val[n] = assignment[path]
+            src_index.append(index[~is_val])
+            val_index.append(index[is_val])
+            continue
+        src_len = len(index) - int(math.ceil(len(index) * split))
+        if mode == "random":
+            index = random_state.permutation(index)
+            src_index.append(np.sort(index[:src_len]))
+            val_index.append(np.sort(index[src_len:]))
+        else:
+            src_index.append(index[:src_len])
+            val_index.append(index[src_len:][::-1])
+    return src_index, val_index
+
+def split_set(source_path, class_num, split = 0.4, mode = "tail", seed = 0, return_index = False, manifest = False):
     """
     Split the source list into a list of list of source and a list of list of validation
     :param source_path:
     :param class_num:
     :param split:
+    :param mode: "tail", "random" or "hash", see split_index
+    :param seed:
+    :param return_index: also return the flat source and validation line indices
+    :param manifest: hash mode only, keep the side of every path in a manifest next to the list, so lines
+    appended to the list later are the only ones assigned and the others keep their side
     :return:
     """
     source_list = open(source_path).readlines()
-    src_list = []
-    val_list = []
-    for i in range(class_num):
-        src_list.append([j for j in source_list if int(j.split(" ")[1].replace("\n", "")) == i])
-    for j in range(len(src_list)):
-        val = []
-        source_len = len(src_list[j])
-        val_len = math.ceil(source_len * split)
-        for k in range(val_len):
-            val.append(src_list[j][-1])
-            src_list[j].remove(src_list[j][-1])
-        val_list.append(val)
+    assignment = None
+    if manifest and mode == "hash":
+        assignment = load_manifest(manifest_path(source_path, split, seed))
+        known = len(assignment)
+    src_index, val_index = split_index(ImageIndex(source_list), class_num, split, mode, seed, assignment)
+    if assignment is not None and len(assignment) > known:
+        save_manifest(manifest_path(source_path, split, seed), assignment)
+    src_list = [[source_list[k] for k in index] for index in src_index]
+    val_list = [[source_list[k] for k in index] for index in val_index]
+    if return_index:
+        return src_list, val_list, np.concatenate(src_index), np.concatenate(val_index)
     return src_list, val_list
 
+class ChainList(object):
+    """Read-only concatenation of lists, without copying them.
+    Args:
+        lists (list): the lists to chain, in order.
+    """
+
+    def __init__(self, lists):
+        self.lists = lists
+        self.offsets = [0]
+        for sub_list in lists:
+            self.offsets.append(self.offsets[-1] + len(sub_list))
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("ChainList index out of range")
+        which = bisect.bisect_right(self.offsets, index) - 1
+        return self.lists[which][index - self.offsets[which]]
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.lists)
+
 def dimension_rd(src_list):
-    target = []
-    for i in range(len(src_list)):
-        for j in src_list[i]:
-            target.append(j)
-    return target
\ No newline at end of file
+    """
+    Flatten a list of list lazily, the result can be iterated again and again, indexed and measured with len
+    :param src_list:
+    :return:
+    """
+    return ChainList(src_list)
+
+def list_path(image_list):
+    """
+    Image paths of "path label" lines, split once
+    :param image_list:
+    :return:
+    """
+    return [line.split()[0] for line in image_list]
+
+def group_by_class(label, class_num):
+    """
+    Indices of every class with one stable argsort and bincount instead of one scan per class
+    :param label: shape [N], int class of every sample
+    :param class_num:
+    :return: list of class_num index arrays, each in list order, samples labelled outside [0, class_num) are
+    left out as the per-class scans did
+    """
+    label = np.asarray(label, dtype=np.int64)
+    valid = np.where((label >= 0) & (label < class_num))[0]
+    order = valid[np.argsort(label[valid], kind="mergesort")]
+    count = np.bincount(label[valid], minlength=class_num)
+    return np.split(order, np.cumsum(count)[:-1])
@@ -10,6 +10,7 @@ import pre_process as prep
 import torch.nn as nn
 from torch.autograd import Variable
 import seperate_data
+import dev_error
 
 
 def predict_loss(cls, y_pre): #requires how the loss is calculated for the preduct value and the ground truth value
@@ -19,14 +20,10 @@ def predict_loss(cls, y_pre): #requires how the loss is calculated for the predu
     :param y_pre:
     :return:
     """
-    cls_torch = np.full(1, cls)
-    pre_cls_torch = y_pre.double()
-    target = torch.from_numpy(cls_torch).cuda()
-    entropy = nn.CrossEntropyLoss()
-    return entropy(pre_cls_torch, target)
+    return dev_error.batch_error(y_pre, cls).mean()
 
 
-def cross_validation_loss(feature_network, predict_network, src_cls_list, target_path, val_cls_list, class_num, resize_size, crop_size, batch_size, use_gpu):
+def cross_validation_loss(feature_network, predict_network, src_cls_list, target_path, val_cls_list, class_num, resize_size, crop_size, batch_size, use_gpu, error_type="cross_entropy"):
     """
     Main function for computing the CV loss
     :param feature_network:
@@ -38,6 +35,7 @@ def cross_validation_loss(feature_network, predict_network, src_cls_list, target
     :param resize_size:
     :param crop_size:
     :param batch_size:
+    :param error_type: key of dev_error.error_dict
     :return:
     """
     val_cls_list = seperate_data.dimension_rd(val_cls_list)
@@ -55,18 +53,7 @@ def cross_validation_loss(feature_network, predict_network, src_cls_list, target
         val_input, val_labels = Variable(val_input), Variable(val_labels)
 
     _, pred_label = predict_network(val_input)
-
-    w = pred_label[0].shape[0]
-
-    error = np.zeros(1)
-    error[0] = predict_loss(val_labels[0].item(), pred_label[0].reshape(1, w)).item()
-    error = error.reshape(1, 1)
-    for num_image in range(1, len(pred_label)):
-        single_pred_label = pred_label[num_image]
-        w = single_pred_label.shape[0]
-        single_val_label = val_labels[num_image]
-        error = np.append(error, [[predict_loss(single_val_label.item(), single_pred_label.reshape(1, w)).item()]],
-                          axis=0)
+    error = [dev_error.batch_error(pred_label, val_labels, error_type).detach().cpu().numpy()]
 
     for _ in range(len(iter_val) - 1):
         val_input, val_labels = iter_val.next()
@@ -75,14 +62,9 @@ def cross_validation_loss(feature_network, predict_network, src_cls_list, target
         else:
             val_input, val_labels = Variable(val_input), Variable(val_labels)
         _, pred_label = predict_network(val_input)
-        for num_image in range(len(pred_label)):
-            single_pred_label = pred_label[num_image]
-            w = single_pred_label.shape[0]
-            single_val_label = val_labels[num_image]
-            error = np.append(error, [[predict_loss(single_val_label.item(), single_pred_label.reshape(1, w)).item()]],
-                              axis=0)
+        error.append(dev_error.batch_error(pred_label, val_labels, error_type).detach().cpu().numpy())
 
-    cross_val_loss = error.sum()
+    cross_val_loss = np.concatenate(error).sum()
     # for cls in range(class_num):
     #
     #     dsets_val = ImageList(val_cls_list[cls], transform=prep_dict_val)
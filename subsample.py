@@ -0,0 +1,87 @@
+import numpy as np
+
+
+def random_select_index(N, size):
+    """
+    Sorted random rows without replacement, sorted so memory-mapped features are read sequentially
+    :param N: number of rows to choose from
+    :param size: number of rows to choose, at most N
+    :return: int64 numpy array [size]
+    """
+    return np.sort(np.random.choice(N, size, replace=False)).astype(np.int64)
+
+
+def random_select_src(source_feature, target_feature, ratio=2):
+    """
+    Select ratio*N_te data from source feature randomly with a single fancy index
+    :param source_feature: shape [N_tr, d], features from training set, numpy array or memory map
+    :param target_feature: shape [N_te, d], features from test set
+    :param ratio: at most ratio source rows per target row are kept
+    :return: shape [min(N_tr, ratio*N_te), d]
+    """
+    N_s = source_feature.shape[0]
+    N_t = target_feature.shape[0]
+    new_source_feature = source_feature[random_select_index(N_s, min(N_s, int(ratio * N_t)))]
+    print("random_select:")
+    print(new_source_feature.shape)
+    return new_source_feature
+
+
+class ClassReservoir(object):
+    """Uniform random subsample of every class, filled batch by batch while features are being extracted.
+
+    Every class keeps at most ``capacity[cls]`` rows using reservoir sampling (Algorithm R), so the whole
+    source set never has to be held in memory. A class that sees fewer rows than its capacity keeps all of them,
+    in extraction order.
+    Args:
+        capacity (array): maximum number of rows kept for every class, e.g. 2 * the target class counts.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = np.asarray(capacity, dtype=np.int64)
+        self.seen = np.zeros(len(self.capacity), dtype=np.int64)
+        self.feature = [None] * len(self.capacity)
+
+    def update(self, feature, label):
+        """
+        :param feature: shape [n, d], one extracted batch
+        :param label: shape [n], class of every row
+        """
+        label = np.asarray(label)
+        for cls in np.unique(label):
+            cls_feature = feature[label == cls]
+            capacity = self.capacity[cls]
+            if capacity == 0:
+                self.seen[cls] += len(cls_feature)
+                continue
+            if self.feature[cls] is None:
+                self.feature[cls] = np.empty((capacity,) + cls_feature.shape[1:], dtype=cls_feature.dtype)
+            # position of every row in the stream of its class
+            position = self.seen[cls] + np.arange(len(cls_feature))
+            fill = position < capacity
+            self.feature[cls][position[fill]] = cls_feature[fill]
+            # row t replaces a random slot with probability capacity / (t + 1)
+            slot = (np.random.random_sample(len(position)) * (position + 1)).astype(np.int64)
+            replace = (~fill) & (slot < capacity)
+            if replace.any():
+                # later rows win when two of them land on the same slot, as in the sequential algorithm
+                slot, row = slot[replace][::-1], np.where(replace)[0][::-1]
+                slot, first = np.unique(slot, return_index=True)
+                self.feature[cls][slot] = cls_feature[row[first]]
+            self.seen[cls] += len(cls_feature)
+
+    def result(self):
+        """
+        :return: kept features [n, d] and their classes [n], grouped by class
+        """
+        features = []
+        labels = []
+        for cls in range(len(self.capacity)):
+            if self.feature[cls] is None:
+                continue
+            kept = min(self.seen[cls], self.capacity[cls])
+            features.append(self.feature[cls][:kept])
+            labels.append(np.full(kept, cls, dtype=np.int64))
+        if not features:
+            return np.zeros((0, 0), dtype=np.float32), np.zeros(0, dtype=np.int64)
+        return np.concatenate(features), np.concatenate(labels)